@@ -0,0 +1,290 @@
+
+# Benchmark the bot's hot paths, compared against a saved baseline
+#
+#   python benchmarks/run.py                    run everything, compare with benchmarks/baseline.json (fails if missing)
+#   python benchmarks/run.py -k store           only benchmarks with 'store' in their name
+#   python benchmarks/run.py --save-baseline    run and make the results the new baseline
+
+import os, sys, json, time, shutil, asyncio, argparse, platform, statistics, tempfile, contextlib
+
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE_FILE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+RESULTS_FILE = os.path.join(ROOT, 'benchmarks', 'results.json')
+
+# Seconds one timed repeat should take at least
+MIN_REPEAT_TIME = 0.2
+
+benchmarks = [] # (name, setup)
+
+
+# Register a setup function, called with each param, returning the callable to time
+def benchmark(name, params=(None,)):
+    def register(setup):
+        for param in params:
+            benchmarks.append((name if param is None else f'{name}[{param}]', lambda param=param: setup(param) if param is not None else setup()))
+        return setup
+    return register
+
+
+# ===========================================
+# Fixture - config and game library copied somewhere the benchmarks can change freely
+def fixture():
+    path = tempfile.mkdtemp(prefix='disc-bench-')
+    shutil.copytree(os.path.join(ROOT, 'config'), os.path.join(path, 'config'))
+
+    game_file = os.path.join(path, 'config', 'launcher', 'games.json')
+    with open(game_file) as file:
+        games = json.load(file)
+    games['library']['path'] = os.path.join(ROOT, 'games')
+    with open(game_file, 'w') as file:
+        json.dump(games, file, indent=4)
+
+    os.makedirs(os.path.join(path, 'data'))
+    os.chdir(path)
+    return path
+
+
+# ===========================================
+# Benchmarks
+@benchmark('events_emit', params=(10, 1000, 10000))
+def events_emit(subscribers):
+    from bot.tools.events import Events
+
+    events = Events()
+    for _ in range(subscribers):
+        events.on('second', lambda: None)
+    return lambda: events.emit('second')
+
+
+@benchmark('screen_render_cell', params=(10, 30, 100))
+def screen_render_cell(size):
+    from discgame.monitor import DiscGameScreen
+
+    screen = DiscGameScreen(size)
+    chars = '#@'
+    state = [0]
+    def run():
+        state[0] += 1
+        screen[state[0] % size, state[0] % size] = chars[state[0] % 2]
+        return str(screen)
+    return run
+
+
+@benchmark('screen_render_full', params=(10, 30, 100))
+def screen_render_full(size):
+    from discgame.monitor import DiscGameScreen
+
+    screen = DiscGameScreen(size)
+    chars = '#@'
+    state = [0]
+    def run():
+        state[0] += 1
+        screen.fill(chars[state[0] % 2])
+        return str(screen)
+    return run
+
+
+@benchmark('monitor_send')
+def monitor_send():
+    from discgame import DiscGameMonitor
+    from bot.simulate import FakeREST, FakeBot, FakeGuild, FakeChannel
+
+    bot = FakeBot()
+    guild = FakeGuild(1, 'bench', bot.user)
+    channel = FakeChannel(FakeREST(latency=0, jitter=0), guild, 100, 'bench')
+    monitor = DiscGameMonitor(bot, channel)
+
+    # a new frame every call, so every call edits
+    state = [0]
+    async def run():
+        state[0] += 1
+        await monitor._DiscGameMonitor__send(content=f'```frame {state[0]}```')
+    return run
+
+
+@benchmark('games_validate', params=('any', 'admin'))
+def games_validate(permission):
+    from bot.commands import Games
+    from bot.simulate import FakeBot, FakeGuild, FakeChannel, FakeMember, FakeContext, FakeREST
+    from bot.config import Config
+
+    bot = FakeBot()
+    guild = FakeGuild(1, 'bench', bot.user)
+    channel = FakeChannel(FakeREST(latency=0, jitter=0), guild, 100, 'bench')
+    author = FakeMember(guild, 2, 'bench-user')
+    author.roles = [SimpleNamespace(id=10 + i, name=f'role-{i}') for i in range(10)]
+
+    cog = Games(bot)
+    router = Config().router
+    router.whitelist_ids = frozenset({guild.id})
+
+    # admin commands check the author's roles, through the role cache
+    command = SimpleNamespace(name='bench')
+    router.permissions['bench'] = permission
+    router.grants[permission] = frozenset({'role-9'})
+
+    ctx = FakeContext(bot, channel, author, command, '!bench')
+    validate = cog._Games__validate
+    return lambda: validate(ctx)
+
+
+@benchmark('config_load')
+def config_load():
+    from bot.config import Config
+    return Config().load
+
+
+def store_fixture(items):
+    from bot.tools import store
+
+    store.setDir(os.path.join(tempfile.mkdtemp(prefix='store-', dir=os.getcwd()), ''))
+    store.setFormat(store.FORMAT_JSON)
+    store.setEngine(store.ENGINE_JSON, lazy=False)
+    store.storage.clear()
+    store.meta = {'count': 0, 'list': []}
+
+    store.useCollection('bench')
+    store.setCollection('bench', {str(100000000 + i): {'plays': i, 'wins': i // 2, 'name': f'player-{i}'} for i in range(items)})
+    store.persistCollection('bench')
+    return store
+
+
+@benchmark('store_persist', params=(1000, 100000))
+def store_persist(items):
+    store = store_fixture(items)
+    return lambda: store.persistCollection('bench')
+
+
+@benchmark('store_load', params=(1000, 100000))
+def store_load(items):
+    store = store_fixture(items)
+    return store.load
+
+
+# ===========================================
+# Runner
+def measure(func, repeat):
+    is_coro = asyncio.iscoroutinefunction(func)
+    loop = asyncio.new_event_loop()
+
+    async def timed_async(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return time.perf_counter() - start
+
+    def timed(number):
+        if is_coro:
+            return loop.run_until_complete(timed_async(number))
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - start
+
+    try:
+        # grow the loop count until one repeat takes long enough to time
+        number = 1
+        while True:
+            elapsed = timed(number)
+            if elapsed >= MIN_REPEAT_TIME:
+                break
+            number *= 10 if elapsed < MIN_REPEAT_TIME / 10 else 2
+
+        times = [elapsed / number] + [timed(number) / number for _ in range(repeat - 1)]
+    finally:
+        loop.close()
+
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'number': number,
+        'repeat': repeat
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            result['ratio'] = None
+            continue
+        result['ratio'] = result['min'] / baseline[name]['min']
+        if result['ratio'] > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the bot\'s hot paths')
+    parser.add_argument('-k', dest='filter', default=None, help='only run benchmarks with this in their name')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repeats per benchmark, the fastest one counts')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown against the baseline that counts as a regression')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results over the baseline')
+    args = parser.parse_args(argv)
+
+    cwd = os.getcwd()
+    path = fixture()
+
+    results = {}
+    try:
+        for name, setup in benchmarks:
+            if args.filter and args.filter not in name:
+                continue
+
+            # the store prints every read and write
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                results[name] = measure(setup(), args.repeat)
+            print(f'{name:<28} {format_time(results[name]["min"]):>10}  (median {format_time(results[name]["median"])}, {results[name]["number"]} loops)')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+    regressions = compare(results, baseline, args.threshold)
+
+    print()
+    for name, result in results.items():
+        if result['ratio'] is not None:
+            print(f'{name:<28} {result["ratio"]:>6.2f}x baseline{"  REGRESSION" if name in regressions else ""}')
+        elif baseline:
+            print(f'{name:<28}   none in baseline')
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    for file in [args.output] + ([args.baseline] if args.save_baseline else []):
+        with open(file, 'w') as out:
+            json.dump(report, out, indent=4)
+
+    if regressions:
+        print(f'\n{len(regressions)} benchmarks slower than {args.threshold:.2f}x the baseline')
+        return 1
+
+    # timings only compare on the same machine, so no baseline ships with the repo
+    if not baseline and not args.save_baseline:
+        print(f'No baseline at {args.baseline}, nothing was checked for regressions. Run with --save-baseline on this machine first')
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
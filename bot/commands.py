@@ -8,7 +8,17 @@ import discord
 from discord.ext import commands
 
 from bot.launcher import DiscLauncher
+from bot.lifecycle import LauncherManager
+from bot.library import import_report
+from discgame import DiscGameMonitor
+from discgame.constants import ExecutionMode
 from .tools.events import Events
+from .tools.scheduler import Scheduler
+from .tools.outbound import Outbound, PRIORITIES
+from .tools.metrics import Metrics
+from .tools.workers import WorkerPool
+from .tools.deletions import DeletionQueue
+from .tools import store
 from .config import Config
 from .exceptions import *
 
@@ -25,69 +35,194 @@ class Games(commands.Cog):
         # get config
         self.config = Config()
 
-        # game controllers per server
-        self.launchers = {}
+        # game controllers per server, dead ones are reaped and pooled
+        self.lifecycle = LauncherManager(pool_size=self.config.launcher_pool_size)
+        self.launchers = self.lifecycle.launchers
 
         # get logger
         self.logger = logging.getLogger(self.config.log_name)
 
+        # process-wide metrics, served by the runner's metrics listener
+        self.metrics = Metrics()
+
+        # shared outbound request scheduler
+        self.outbound = Outbound(
+            rate=self.config.outbound_rate,
+            max_in_flight=self.config.outbound_max_in_flight,
+            shed_depth=self.config.outbound_shed_depth,
+            frame_max_wait=self.config.outbound_frame_max_wait,
+            cleanup_max_wait=self.config.outbound_cleanup_max_wait,
+            metrics=self.metrics
+        )
+
+        # player messages in game channels, deleted in bulk
+        self.deletions = DeletionQueue(interval=self.config.delete_interval, outbound=self.outbound, logger=self.logger)
+
+        # worker processes for games that run outside the event loop
+        self.workers = WorkerPool(self.config.game_workers)
+
         self.lock = asyncio.Lock()
 
+        # scheduler timer polling for changed files, one reload at a time
+        self.watch_timer = None
+        self.reload_lock = asyncio.Lock()
+
+        # aliases are picked up when the cog is added to the bot
+        self.__apply_aliases()
+
+        self.__register_metrics()
+
 
     # ===========================================
     # Internal functions
-    # TODO use discord command checks
-    # Validate request server (whitelist)
+    # Validate request server (whitelist) and the author's permission for the command
     def __validate(self, ctx: commands.Context, allowed_in_game=False) -> bool:
-        server = ctx.guild.name
-        author_id = ctx.message.author.id
-        message = ctx.message.content
-        if not self.config.use_whitelist or server in self.config.whitelist:
-            if message.strip().startswith(self.config.bot_prefix):
-                command = message.strip().split(self.config.bot_prefix)[1].split()[0]
-
-                # TODO check against roles config
-                # temp...just check IDs for non-any commands
-                if self.config.commands[command]['permission'] != 'any':
-                    if author_id != 239605736030601216:
-                        self.logger.warning(f'User \'{author_id}\' tried to use admin command: {command}')
-                        return False
-
-                # In game
-                if ctx.guild.id in self.launchers and ctx.channel.id in self.launchers[ctx.guild.id].games:
-                    return allowed_in_game
-
-            return True
+        router = self.config.router
 
-        else:
-            self.logger.warning(f'Server \'{server}\' tried to use this bot!')
+        # discord.py already resolved the command and its aliases
+        command = ctx.command.name
+        if not router.allowed_guild(ctx.guild):
+            self.logger.warning(f'Server \'{ctx.guild.name}\' tried to use this bot!')
+            self.command_count.inc(command, 'guild_denied')
+            return False
+
+        if not router.allowed(command, ctx.author):
+            self.logger.warning(f'User \'{ctx.author.id}\' tried to use {router.permissions[command]} command: {command}')
+            self.command_count.inc(command, 'denied')
             return False
 
+        # In game
+        if ctx.guild.id in self.launchers and ctx.channel.id in self.launchers[ctx.guild.id].games:
+            self.command_count.inc(command, 'ok' if allowed_in_game else 'in_game')
+            return allowed_in_game
+
+        self.command_count.inc(command, 'ok')
+        return True
+
+    # Commands counted as they are validated, everything else is read when scraped
+    def __register_metrics(self):
+        self.command_count = self.metrics.counter('commands_total', 'Commands received, by result', ('command', 'result'))
+
+        self.metrics.gauge('launchers_active', 'Guild launchers that are awake',
+            func=lambda: sum(not launcher.dead for launcher in self.launchers.values()))
+        self.metrics.gauge('launchers_pooled', 'Cleaned launchers waiting for a guild',
+            func=lambda: len(self.lifecycle.pool))
+        self.metrics.gauge('games_active', 'Games running in every guild',
+            func=lambda: sum(len(launcher.games) for launcher in self.launchers.values()))
+        self.metrics.gauge('input_queue_depth', 'Player messages waiting for their games',
+            func=lambda: sum(len(instance.input) for launcher in self.launchers.values() for instance in launcher.games.values()))
+        self.metrics.gauge('outbound_queue_depth', 'Discord requests waiting in the outbound scheduler', ('priority',),
+            func=lambda: {(name,): sum(len(requests) for requests in self.outbound.queues[level].values()) for name, level in PRIORITIES.items()})
+        self.metrics.gauge('outbound_in_flight', 'Discord requests waiting on a response',
+            func=lambda: self.outbound.in_flight)
+        self.metrics.gauge('deletion_queue_depth', 'Player messages waiting to be deleted',
+            func=lambda: self.deletions.stats()['queued'])
+        self.metrics.gauge('scheduler_timers', 'Timers registered with the shared scheduler',
+            func=lambda: Scheduler().count)
+
+    # Register the aliases from commands.json, re-registering commands that are already added
+    def __apply_aliases(self):
+        for command in self.get_commands():
+            aliases = self.config.router.aliases(command.name)
+            if aliases == list(command.aliases):
+                continue
+
+            registered = self.bot.get_command(command.name) is command
+            if registered:
+                self.bot.remove_command(command.name)
+            command.aliases = aliases
+            if registered:
+                self.bot.add_command(command)
+
+    # Reply to a command, ahead of game traffic
+    async def __reply(self, ctx: commands.Context, content):
+        return await self.outbound.submit('command', ctx.guild.id, ('send', ctx.channel.id), ctx.send, content)
+
+    # Reload whatever changed on disk, skipped while a reload is still running
+    async def __watch(self):
+        if self.reload_lock.locked():
+            return
+        try:
+            changed = await self.__reload()
+        except ConfigLoadError as e:
+            self.logger.error(f'Reload failed: {str(e)}')
+            return
+
+        if changed:
+            self.logger.info(f'Reloaded: {", ".join(changed)}')
+
+    # Files are hashed and game modules re-imported off the event loop, only the swap happens on it
+    async def __reload(self):
+        async with self.reload_lock:
+            staged = await asyncio.get_running_loop().run_in_executor(None, self.config.stage_reload)
+            changed = self.config.apply_reload(staged)
+
+        if 'config' in changed or 'commands' in changed:
+            self.__apply_aliases()
+
+        # the outbound scheduler is process-wide and outlives config snapshots
+        if 'config' in changed:
+            self.outbound.configure(
+                rate=self.config.outbound_rate,
+                max_in_flight=self.config.outbound_max_in_flight,
+                shed_depth=self.config.outbound_shed_depth,
+                frame_max_wait=self.config.outbound_frame_max_wait,
+                cleanup_max_wait=self.config.outbound_cleanup_max_wait
+            )
+        return changed
+
+    # Import every game module off the event loop, then log the slowest imports
+    async def __prewarm(self):
+        loop = asyncio.get_running_loop()
+        for ref, entry in self.config.game_lib.items():
+            if entry.loaded or entry.get('execution', ExecutionMode.INLINE) != ExecutionMode.INLINE:
+                continue
+            try:
+                await loop.run_in_executor(None, entry.load)
+            except GameLoadError as e:
+                self.logger.error(f'Failed to prewarm game \'{ref}\': {str(e)}')
+
+        for ref, module, seconds in import_report(self.config.game_lib):
+            self.logger.debug(f'Game import time: {ref} ({module}) {seconds:.3f}s')
+
     # # Internal tick (wide interval)
     # async def __tick_loop(self):
     #     while True:
     #         await asyncio.sleep(10)
     #         self.events.emit('tick')
 
-    # # Periodically check for dead launchers and remove them
-    # async def __clean_launchers(self):
-    #     self.logger.debug('Looking for dead launchers...')
-    #     async with self.lock:
-    #         for name, launcher in self.launchers:
-    #             if launcher.dead:
-    #                 self.logger.debug('Found dead launcher [{launcher.name}], terminating')
-    #                 launcher.clean()
-    #                 del self.launchers[name]
-
     # ===========================================
     # General listeners
     @commands.Cog.listener()
     async def on_ready(self):
+        Scheduler().start()
+        store.startFlusher(self.config.storage_flush_interval, self.config.storage_flush_threshold)
+
+        # messages may have been missed while disconnected
+        DiscGameMonitor.invalidate_messages()
         self.logger.info('Bot is ready!')
 
+        # periodically reap dead launchers
+        self.lifecycle.start(self.config.launcher_sweep_interval)
+
+        # poll for changed config and game files
+        if self.config.watch_interval > 0 and self.watch_timer is None:
+            self.watch_timer = Scheduler().every(self.config.watch_interval, self.__watch)
+
+        # import game modules in the background so the first play doesn't wait
+        if self.config.game_prewarm:
+            asyncio.get_running_loop().create_task(self.__prewarm())
+
+    @commands.Cog.listener()
+    async def on_resumed(self):
+        DiscGameMonitor.invalidate_messages()
+
     @commands.Cog.listener()
     async def on_message(self, msg):
 
+        # keep game monitors aware of the last message in their channel
+        DiscGameMonitor.track_message(msg.channel.id, msg.id)
+
         # ignore bot messages
         if msg.author.id == self.bot.user.id:
             return
@@ -96,15 +231,31 @@ class Games(commands.Cog):
         if msg.guild.id in self.launchers:
             if self.launchers[msg.guild.id].get_game(msg.channel.id):
 
+                # remove the message, deletions are batched per channel
+                self.deletions.add(msg)
+                DiscGameMonitor.forget_message(msg.channel.id, msg.id)
+
                 # handle non-bot commands
-                if not msg.content.strip().startswith(self.config.bot_prefix):
+                if not self.config.router.is_command(msg.content):
 
                     # send message along to launcher
                     self.logger.debug(f'GAME MSG| server: {msg.guild.name} channel: {msg.channel.id} | {msg.content}') 
                     await self.launchers[msg.guild.id].game_message(msg.channel.id, msg.author.id, msg.content)   
-                
-                # remove the message
-                await msg.delete()
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        DiscGameMonitor.forget_message(payload.channel_id, payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            DiscGameMonitor.forget_message(payload.channel_id, message_id)
+
+    # Role changes take effect before the role cache expires
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.config.router.role_cache.invalidate(after.guild.id, after.id)
 
     @commands.Cog.listener()
     async def on_disconnect(self):
@@ -124,7 +275,7 @@ class Games(commands.Cog):
 
         # Check input format
         if len(game) == 0:
-            await ctx.send('Please specify the game you want to play.')
+            await self.__reply(ctx, 'Please specify the game you want to play.')
             return
 
         game_ref = ' '.join(game)
@@ -133,9 +284,8 @@ class Games(commands.Cog):
         async with self.lock:
             if ctx.guild.id not in self.launchers:
                 self.logger.info(f'No existing launcher for guild \'{ctx.guild.name}\' - creating launcher')
-                self.launchers[ctx.guild.id] = DiscLauncher(ctx.bot, ctx.channel.name)
 
-            launcher: DiscLauncher = self.launchers[ctx.guild.id]
+            launcher: DiscLauncher = self.lifecycle.get(ctx.bot, ctx.guild.id, ctx.channel.name)
 
             # Tell launcher to start the referenced game
             try:
@@ -143,7 +293,11 @@ class Games(commands.Cog):
             except GameAlreadyRunningException as e:
                 self.logger.debug(str(e))
             except InvalidGameException as e:
-                await ctx.send(f'The game \'{game_ref}\' isn\'t in my library.')
+                await self.__reply(ctx, f'The game \'{game_ref}\' isn\'t in my library.')
+                return
+            except GameLoadError as e:
+                self.logger.error(f'Failed to load game \'{game_ref}\': {str(e)}')
+                await self.__reply(ctx, f'The game \'{game_ref}\' couldn\'t be loaded.')
                 return
 
     @commands.command()
@@ -157,6 +311,10 @@ class Games(commands.Cog):
             return
 
         launcher: DiscLauncher = self.launchers[ctx.guild.id]
+        if launcher.get_game(ctx.channel.id) is None:
+            self.logger.debug(f'No game in channel {ctx.channel.id} - do nothing')
+            return
+
         self.logger.info(f'Attempting to end game in channel {ctx.channel.id}: {launcher.get_game(ctx.channel.id).title}')
 
         await launcher.end_game(ctx.channel.id, ctx.author.id)
@@ -178,7 +336,7 @@ class Games(commands.Cog):
             return
 
         game_list = self.config.game_lib.keys()
-        await ctx.send('Games: ' + ', '.join(game_list))
+        await self.__reply(ctx, 'Games: ' + ', '.join(game_list))
 
 
     # Admin commands
@@ -190,9 +348,14 @@ class Games(commands.Cog):
 
         self.logger.info('Reloading bot config...')
 
-        self.config.load()
+        try:
+            changed = await self.__reload()
+        except ConfigLoadError as e:
+            self.logger.error(f'Reload failed: {str(e)}')
+            await self.__reply(ctx, 'Reload failed, check the log.')
+            return
 
-        self.logger.info('Done')
+        self.logger.info(f'Done, reloaded: {", ".join(changed) if changed else "nothing changed"}')
 
 
 
@@ -1,11 +1,14 @@
 
 # Store config values
 
-import os, sys, shutil, logging, json, importlib
+import os, sys, shutil, logging, json
 import configparser
 
 from bot.exceptions import ConfigLoadError, GameLoadError
-from bot.tools.util import path_resolve, Singleton
+from bot.tools.util import path_resolve, file_signature, signature_changed, Singleton
+from bot.library import GameEntry
+from bot.router import CommandRouter
+from discgame.constants import GameDefaults, TickPolicy, RepostPolicy, ExecutionMode, InputPolicy
 
 # Log level translation
 LOG_LEVEL = {
@@ -36,7 +39,7 @@ class Config(metaclass=Singleton):
         self.file = path_resolve(file)
 
         # guaranteed to exist, need this for references to the DiscGame lib
-        sys.path.append(path_resolve('discgame'))
+        self.__add_path(path_resolve('discgame'))
 
         # Try to copy from template if not found
         if not os.path.isfile(self.file):
@@ -51,20 +54,79 @@ class Config(metaclass=Singleton):
         self.whitelist = [] # [servers]
         self.game_lib_config = {} # config game lib metadata
         self.game_lib = {} # game library
+        self.sources = {} # file: signature when last parsed
+
+        self.__swap(self.__stage(force=True))
+
+    # Re-parse only the files that changed since the last load, returns the names of reloaded parts.
+    # Nothing is swapped in unless every changed file parses. Blocks on file hashing and imports,
+    # async code runs stage_reload() in the executor and apply_reload() on the event loop instead
+    def reload(self) -> list:
+        return self.apply_reload(self.stage_reload())
+
+    # Changed files re-parsed and changed game modules re-imported into a staged copy, safe off the event loop
+    def stage_reload(self):
+        staged = self.__stage(force=False)
+        staged.failed = []
+        for ref, entry in staged.game_lib.items():
+            if entry.stale():
+                try:
+                    entry.reload()
+                    staged.changed.append(ref)
+                except GameLoadError as e:
+                    staged.failed.append(str(e))
+        return staged
+
+    # Swap in a staged config, running games keep the classes they were created with
+    def apply_reload(self, staged) -> list:
+        self.__swap(staged)
+        if staged.failed:
+            raise ConfigLoadError(f'GameLoadError: {"; ".join(staged.failed)}')
+        return list(staged.changed)
+
+    # Build a copy of the config with changed files re-parsed
+    def __stage(self, force=False):
+        staged = object.__new__(Config)
+        staged.__dict__.update(self.__dict__)
+        staged.sources = dict(self.sources)
+        staged.changed = []
 
         # Propogate load errors
         try:
             # Load config
-            self.__load_config()
+            if staged.__changed(staged.file, force):
+                staged.__load_config()
+                staged.changed.append('config')
 
             # Load command aliases and help
-            self.__load_commands()
+            if staged.__changed(staged.commands_file, force):
+                staged.commands = {}
+                staged.__load_commands()
+                staged.changed.append('commands')
 
             # Load server whitelist
-            self.__load_whitelist()
+            if staged.__changed(staged.whitelist_file, force):
+                staged.whitelist = []
+                staged.__load_whitelist()
+                staged.changed.append('whitelist')
+
+            # Rebuild command routing when any of its inputs changed
+            if {'config', 'commands', 'whitelist'} & set(staged.changed):
+                staged.router = CommandRouter(
+                    staged.bot_prefix, staged.commands, staged.whitelist,
+                    use_aliases=staged.use_aliases,
+                    use_whitelist=staged.use_whitelist,
+                    permissions=staged.permissions,
+                    owners=staged.owners,
+                    role_ttl=staged.role_cache_ttl
+                )
 
             # Load game library
-            self.__load_games()
+            if staged.__changed(staged.game_file, force):
+                staged.game_lib_config = {}
+                staged.game_lib = {}
+                staged.__load_games(previous=self.game_lib)
+                staged.changed.append('games')
 
         except ConfigLoadError as e:
             raise ConfigLoadError(f'ConfigLoadError: {str(e)}')
@@ -73,6 +135,23 @@ class Config(metaclass=Singleton):
         except Exception as e:
             raise ConfigLoadError(f'uncaught {type(e)}: {str(e)}')
 
+        return staged
+
+    def __swap(self, staged):
+        self.__dict__.update(staged.__dict__)
+
+    # Record the file's signature, True if it needs to be parsed again
+    def __changed(self, path, force=False):
+        previous = self.sources.get(path)
+        current = file_signature(path, previous)
+        self.sources[path] = current
+        return force or previous is None or signature_changed(previous, current)
+
+    # Only add import paths once, reloads would otherwise grow sys.path
+    def __add_path(self, path):
+        if path not in sys.path:
+            sys.path.append(path)
+
 
     def __load_config(self):
 
@@ -95,13 +174,61 @@ class Config(metaclass=Singleton):
         self.use_whitelist = config.getint('bot', 'whitelist_disable', fallback=0) == 0
         self.whitelist_file = path_resolve(config.get('bot', 'whitelist_file', fallback='config/bot/whitelist'), force_exists=False)
 
+        # Command permissions (permission name: role ids or names granting it, owners pass every check)
+        self.owners = [int(owner) for owner in config.get('permissions', 'owners', fallback='').split(',') if owner.strip()]
+        self.role_cache_ttl = config.getfloat('permissions', 'role_cache_ttl', fallback=60.0)
+        self.permissions = {}
+        if config.has_section('permissions'):
+            for name, roles in config.items('permissions'):
+                if name in ('owners', 'role_cache_ttl'):
+                    continue
+                roles = [role.strip() for role in roles.split(',') if role.strip()]
+                self.permissions[name] = [int(role) if role.isdigit() else role for role in roles]
+
         # Launcher params
         self.launcher_idle_timeout = config.getint('bot', 'idle_timeout', fallback=60)
+        self.launcher_sweep_interval = config.getint('bot', 'sweep_interval', fallback=60)
+        self.launcher_pool_size = config.getint('bot', 'launcher_pool_size', fallback=8)
+
+        # Seconds player messages in game channels wait to be deleted in bulk
+        self.delete_interval = config.getfloat('bot', 'delete_interval', fallback=1.0)
+
+        # Reload watch (seconds between checks for changed config and game files, 0 disables)
+        self.watch_interval = config.getfloat('bot', 'watch_interval', fallback=0)
+
+        # Outbound request scheduler
+        self.outbound_rate = config.getint('outbound', 'rate', fallback=50)
+        self.outbound_max_in_flight = config.getint('outbound', 'max_in_flight', fallback=20)
+        self.outbound_shed_depth = config.getint('outbound', 'shed_depth', fallback=1000)
+        self.outbound_frame_max_wait = config.getfloat('outbound', 'frame_max_wait', fallback=5.0)
+        self.outbound_cleanup_max_wait = config.getfloat('outbound', 'cleanup_max_wait', fallback=2.0)
+
+        # Sharded run mode (gateway shards, worker processes sharing them)
+        self.shard_count = config.getint('shards', 'count', fallback=1)
+        self.shard_processes = config.getint('shards', 'processes', fallback=1)
+        self.shard_restart_delay = config.getfloat('shards', 'restart_delay', fallback=5.0)
+
+        # Metrics listener (Prometheus text format, 0 disables, sharded processes add their index to the port)
+        self.metrics_host = config.get('metrics', 'host', fallback='127.0.0.1')
+        self.metrics_port = config.getint('metrics', 'port', fallback=0)
+
+        # Storage config
+        self.storage_dir = path_resolve(config.get('storage', 'dir', fallback='data/'), force_exists=False)
+        self.storage_engine = config.get('storage', 'engine', fallback='json').lower()
+        self.storage_flush_interval = config.getfloat('storage', 'flush_interval', fallback=5.0)
+        self.storage_flush_threshold = config.getint('storage', 'flush_threshold', fallback=1000)
+        self.storage_format = config.get('storage', 'format', fallback='json').lower()
+        self.storage_compress = config.getint('storage', 'compress', fallback=0) == 1
+        self.storage_lazy = config.getint('storage', 'lazy_disable', fallback=0) == 0
+        self.storage_cache_size = config.getint('storage', 'cache_size', fallback=0)
 
         # Game config
+        self.game_idle_timeout = config.getint('game', 'idle_timeout', fallback=GameDefaults.idle_timeout)
 
         # Launcher config
         self.game_file = path_resolve(config.get('launcher', 'game_file', fallback='config/launcher/games.json'), force_exists=False)
+        self.game_prewarm = config.getint('launcher', 'prewarm_disable', fallback=0) == 0
+        self.game_workers = config.getint('launcher', 'workers', fallback=0)
 
         # Logging config
         temp_level = config.get('logging', 'level', fallback='info').lower()
@@ -162,7 +289,9 @@ class Config(metaclass=Singleton):
                 self.whitelist.append(server.strip())
 
 
-    def __load_games(self):
+    def __load_games(self, previous=None):
+
+        previous = previous or {}
 
         if not os.path.isfile(self.game_file):
             raise ConfigLoadError(f'Game library error: no file \'{self.game_file}\'')
@@ -191,7 +320,7 @@ class Config(metaclass=Singleton):
                 self.game_lib_config['path'] = game_lib['library']['path']
 
                 # add game library to path
-                sys.path.append(self.game_lib_config['path'])
+                self.__add_path(self.game_lib_config['path'])
 
             else:
                 raise ConfigLoadError(f'Game library error: no library info in \'{self.game_file}\'')
@@ -207,43 +336,40 @@ class Config(metaclass=Singleton):
                             raise GameLoadError(f'Game library entry missing required fields: {diff}')
 
 
-                        # check that the game's path exists
-                        if not os.path.isdir(os.path.join(self.game_lib_config['path'], entry['path'])):
-                            raise GameLoadError(f'Game ({entry["ref"]}) path not found: {entry["path"]}')
-
-
-                        # check for the game's object file
-                        object_file = entry['class'].strip().split('.')[0]
-                        object_class = entry['class'].strip().split('.')[1]
-
-                        if not os.path.isfile(f'{os.path.join(self.game_lib_config["path"], entry["path"], object_file)}.py'):
-                            raise GameLoadError(f'Game ({entry["ref"]}) object file not found: {object_file}')
-
-
-                        # attempt to load the game path and object
-                        module = None
-                        try:
-                            module = importlib.import_module(f'{entry["path"]}.{object_file}')
-                        except Exception as e:
-                            raise GameLoadError(f'Game ({entry["ref"]}) module could not be loaded: {str(e)}')
-                        
-                        # grab the entry DiscGame object
-                        cls = None
-                        if hasattr(module, object_class):
-                            cls = getattr(module, object_class)
-                        else:
-                            raise GameLoadError(f'Game ({entry["ref"]}) object could not be found: {object_class}')
-
-
-                        # add game to library
-                        if cls is not None:
-                            self.game_lib[entry['ref']] = entry
-                            self.game_lib[entry['ref']]['object'] = cls
+                        # check optional tick dispatch settings
+                        if 'tick_policy' in entry and entry['tick_policy'] not in TickPolicy.ALL:
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid tick policy: {entry["tick_policy"]}')
+                        if 'tick_queue_size' in entry and (not isinstance(entry['tick_queue_size'], int) or entry['tick_queue_size'] < 1):
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid tick queue size: {entry["tick_queue_size"]}')
+                        if 'max_fps' in entry and (not isinstance(entry['max_fps'], (int, float)) or entry['max_fps'] <= 0):
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid max frame rate: {entry["max_fps"]}')
+                        if 'repost_policy' in entry and entry['repost_policy'] not in RepostPolicy.ALL:
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid repost policy: {entry["repost_policy"]}')
+                        if 'repost_interval' in entry and (not isinstance(entry['repost_interval'], (int, float)) or entry['repost_interval'] < 0):
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid repost interval: {entry["repost_interval"]}')
+                        if 'execution' in entry and entry['execution'] not in ExecutionMode.ALL:
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid execution mode: {entry["execution"]}')
+
+                        # check optional input queue settings
+                        if 'input_policy' in entry and entry['input_policy'] not in InputPolicy.ALL:
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid input policy: {entry["input_policy"]}')
+                        for field in ('input_queue_size', 'input_user_limit'):
+                            if field in entry and (not isinstance(entry[field], int) or entry[field] < 1):
+                                raise GameLoadError(f'Game ({entry["ref"]}) has an invalid {field}: {entry[field]}')
+                        if 'idle_timeout' in entry and (not isinstance(entry['idle_timeout'], (int, float)) or entry['idle_timeout'] < 0):
+                            raise GameLoadError(f'Game ({entry["ref"]}) has an invalid idle timeout: {entry["idle_timeout"]}')
+
+
+                        # check the class specifier, the module itself is imported on first use
+                        if len(entry['class'].strip().split('.')) < 2:
+                            raise GameLoadError(f'Game ({entry["ref"]}) class must be given as file.Class: {entry["class"]}')
+
+
+                        # add game to library, keeping the imported class of unchanged entries
+                        if entry['ref'] in previous and previous[entry['ref']].matches(entry, self.game_lib_config['path']):
+                            self.game_lib[entry['ref']] = previous[entry['ref']]
                         else:
-                            raise GameLoadError(f'Game ({entry["ref"]}) object could not be loaded: {object_class}')
-
-
-                        #print(f'loaded game {self.game_lib[entry["ref"]]["object"].__name__}')
+                            self.game_lib[entry['ref']] = GameEntry(entry, self.game_lib_config['path'])
 
             else:
                 self.game_lib = {}
@@ -1,15 +1,24 @@
 
 # Game launcher - handle games for a discord server
 
-import logging, asyncio
+import logging, asyncio, time, traceback
 
 from datetime import datetime
 
 from .tools.events import Events
+from .tools.scheduler import Scheduler
+from .tools.outbound import Outbound
+from .tools.metrics import Metrics
+from .tools.workers import WorkerPool
+from .tools.util import deep_sizeof
 from .config import Config
 from .exceptions import GameAlreadyRunningException, InvalidGameException
 
 from discgame import DiscGame, DiscGameMonitor
+from discgame.constants import ExecutionMode
+from discgame.worker import ProcessGame
+from discgame.input import InputQueue
+from discgame.timers import TimerHeap
 
 class DiscGameInstance:
     ''''''
@@ -23,19 +32,68 @@ class DiscGameInstance:
         self.cls = data['class']            # DiscGame object specifier from config
 
         # DiscGameMonitor used to update screen
-        self.monitor: DiscGameMonitor = DiscGameMonitor(bot, text_channel)
+        self.monitor: DiscGameMonitor = DiscGameMonitor(
+            bot, text_channel,
+            max_fps=data.get('max_fps'),
+            repost_policy=data.get('repost_policy'),
+            repost_interval=data.get('repost_interval'),
+            outbound=Outbound(),
+            metrics=Metrics()
+        )
+
+        # DiscGame object, or its host side stand-in when the game runs in a worker process
+        self.execution = data.get('execution', ExecutionMode.INLINE)
+        if self.execution == ExecutionMode.PROCESS:
+            self.game: DiscGame = ProcessGame(self.monitor, WorkerPool(), data.module_name, data.object_class, data.lib_path)
+        else:
+            self.game: DiscGame = data.load()(self.monitor)
+
+        # tick policy override from config
+        if 'tick_policy' in data:
+            self.game.tick_policy = data['tick_policy']
+        if 'tick_queue_size' in data:
+            self.game.tick_queue_size = data['tick_queue_size']
+
+        # player messages waiting for the game
+        self.input = InputQueue(data.get('input_queue_size'), data.get('input_policy'), data.get('input_user_limit'))
+        self.game.input = self.input
+        self.consumer = None
 
-        # DiscGame object
-        self.game: DiscGame = data['object'](self.monitor)          
+        # idle timeout, checked only when its deadline comes up
+        self.game.idle_timeout = data.get('idle_timeout', Config().game_idle_timeout)
+        self.last_active = time.monotonic()
+        self.idle_deadline = None
 
 
     async def startup(self):
         await self.monitor.send('Starting game...')
         await self.game._start_interal()
 
+        # batched games drain the queue on their second tick, everyone else gets messages in order
+        if not (self.game.input_batch and self.game.second_ticks):
+            self.consumer = asyncio.get_running_loop().create_task(self.__consume())
+
     async def shutdown(self):
-        await self.game._end_internal()
-        await self.monitor.clean()
+        # a game may be ended from its own message handler, don't cancel that
+        if self.consumer is not None and self.consumer is not asyncio.current_task():
+            self.consumer.cancel()
+        self.consumer = None
+
+        try:
+            await self.game._end_internal()
+        finally:
+            await self.monitor.clean()
+
+    # Deliver queued messages one at a time, a slow game holds the queue instead of piling up tasks
+    async def __consume(self):
+        while True:
+            user_id, content = await self.input.get()
+            try:
+                await self.game._message_interal(user_id, content)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
 
 
 class DiscLauncher:
@@ -45,11 +103,28 @@ class DiscLauncher:
         self.config = Config()
         self.logger = logging.getLogger(self.config.log_name)
 
+        # Events
+        self.metrics = Metrics()
+        self.events = Events(self.logger, metrics=self.metrics)
+        self.scheduler = Scheduler()
+        self.timers = []
+        self.deadlines = TimerHeap.shared()
+        self.tasks = set()
+        self.lock = asyncio.Lock()
+
+        # how far each second tick ran behind the last one plus a second
+        self.tick_lag = self.metrics.histogram('tick_lag_seconds', 'Seconds a launcher tick ran behind the 1s cadence')
+        self.last_tick = None
+
+        self.reset(bot, name)
+
+    # (Re)initialize for a guild, pooled launchers are reset instead of rebuilt
+    def reset(self, bot, name):
         self.name = name
         self.running = True
         self.start_time = datetime.now()
         self.restart_time = self.start_time
-        self.idle_time = -1
+        self.idle_deadline = None
         self.dead = False
 
         # Game data per channel
@@ -58,47 +133,25 @@ class DiscLauncher:
         # Bot context
         self.bot = bot
 
-        # Events
-        self.events = Events()
-        self.lock = asyncio.Lock()
         self.wake()
 
 
     # ===========================================
     # Events
-    async def update_loop(self):
-        min_counter = 0
-        while(self.running):
-            await asyncio.sleep(1)
-
-            # emit to all games that a second has passed
-            self.events.emit('second')
-
-            # check launcher idle time
-            if self.idle_time == -1:
-                if len(self.games) == 0:
-                    self.idle_time = datetime.now()
-            else:
-                if len(self.games) > 0:
-                    self.idle_time = -1
-                    self.dead = False
-                else:
-                    total_idle = (datetime.now() - self.idle_time).total_seconds()
-                    if total_idle >= self.config.launcher_idle_timeout:
-                        if not self.dead:
-                            self.logger.info(f'Launcher [{self.name}] has been idle for {self.config.launcher_idle_timeout} seconds, marked as dead')
-                            self.dead = True
-
-                            # hibernate the launcher
-                            self.hibernate()
-                            return
-            
-            min_counter += 1
-            if min_counter >= 59:
-
-                # emit to all games that a minute has passed
-                self.events.emit('minute')
-                min_counter = 0
+    # Scheduler tick, fanned out to all games
+    def _tick_second(self):
+        now = time.monotonic()
+        if self.last_tick is not None:
+            self.tick_lag.observe(max(0.0, now - self.last_tick - 1))
+        self.last_tick = now
+
+        # emit to all games that a second has passed
+        self.events.emit('second')
+
+    def _tick_minute(self):
+
+        # emit to all games that a minute has passed
+        self.events.emit('minute')
 
     async def _every_minute(self):
         self.logger.debug(f'Launcher [{self.name}] has been alive for {(datetime.now() - self.restart_time).total_seconds():.1f} seconds')
@@ -150,15 +203,30 @@ class DiscLauncher:
 
         self.logger.info(f'Starting game \'{game_ref}\' in channel {channel_id} [path: {game_data["path"]}, class: {game_data["class"]}]')
 
+        # import the game module on first use, off the event loop (worker processes import their own)
+        if not game_data.loaded and game_data.get('execution', ExecutionMode.INLINE) == ExecutionMode.INLINE:
+            await asyncio.get_running_loop().run_in_executor(None, game_data.load)
+            self.logger.info(f'Imported game \'{game_ref}\' in {game_data.import_time:.3f}s')
+
         # create the game instance
-        self.games[channel_id] = DiscGameInstance(user_id, game_data, self.bot, text_channel)
+        instance = self.games[channel_id] = DiscGameInstance(user_id, game_data, self.bot, text_channel)
+        self.__cancel_idle()
+
+        # register the game tick events, turn-based games skip the second tick
+        if instance.game.second_ticks:
+            self.events.on('second', instance.game._tick_second, weak=True)
+        self.events.on('minute', instance.game._tick_minute, weak=True)
 
-        # register the game tick events
-        self.events.on('second', self.games[channel_id].game._every_second_interal)
-        self.events.on('minute', self.games[channel_id].game._every_minute_interal)
+        # call game startup, a game that fails to start is removed again
+        try:
+            await instance.startup()
+        except Exception:
+            self.logger.error(f'Game \'{game_ref}\' failed to start in channel {channel_id}')
+            await self.__remove_game(channel_id)
+            raise
 
-        # call game startup
-        await self.games[channel_id].startup()
+        if instance.game.idle_timeout:
+            self.__arm_game_idle(channel_id, instance, instance.game.idle_timeout)
 
 
 
@@ -168,26 +236,96 @@ class DiscLauncher:
         # check for existing game
         if self.get_game(channel_id) is None:
             self.logger.debug(f'Ending game: no game to end')
+            return
 
         self.logger.info(f'Ending game \'{self.games[channel_id].ref}\' in channel {channel_id}')
 
-        # deregister the game tick events
-        self.events.off('second', self.games[channel_id].game._every_second_interal)
-        self.events.off('minute', self.games[channel_id].game._every_minute_interal)
+        instance = self.games[channel_id]
+        monitor = instance.monitor
+        await self.__remove_game(channel_id)
+        self.logger.debug(f'Game in channel {channel_id} dropped {monitor.dropped_frames} frames, saved {monitor.edits_saved} edits')
+        self.logger.debug(f'Game in channel {channel_id} input: {instance.input.stats()}')
+
+    # Unsubscribe and shut down a game, it is forgotten even if shutdown fails
+    async def __remove_game(self, channel_id):
+        instance = self.games[channel_id]
+        if instance.idle_deadline is not None:
+            instance.idle_deadline.cancel()
+            instance.idle_deadline = None
+
+        try:
+            self.events.off('second', instance.game._tick_second)
+            self.events.off('minute', instance.game._tick_minute)
+            await instance.shutdown()
+        finally:
+            self.games.pop(channel_id, None)
+            if not self.games:
+                self.__arm_idle()
 
-        await self.games[channel_id].shutdown()
-        del self.games[channel_id]
+    # ===========================================
+    # Idle deadlines
+    # Messages only record the time, an expired deadline re-arms itself for whatever time is left
+    def __arm_game_idle(self, channel_id, instance, delay):
+        instance.idle_deadline = self.deadlines.call_later(delay, self.__game_idle, channel_id, instance)
+
+    def __game_idle(self, channel_id, instance):
+        instance.idle_deadline = None
+        if self.games.get(channel_id) is not instance or not instance.game.idle_timeout:
+            return
+
+        remaining = instance.last_active + instance.game.idle_timeout - time.monotonic()
+        if remaining > 0:
+            self.__arm_game_idle(channel_id, instance, remaining)
+            return
+
+        self.logger.info(f'Game \'{instance.ref}\' in channel {channel_id} has been idle for {instance.game.idle_timeout} seconds, ending')
+        task = asyncio.get_running_loop().create_task(self.end_game(channel_id, None))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def __arm_idle(self):
+        self.__cancel_idle()
+        if self.config.launcher_idle_timeout > 0:
+            self.idle_deadline = self.deadlines.call_later(self.config.launcher_idle_timeout, self.__launcher_idle)
+
+    def __cancel_idle(self):
+        if self.idle_deadline is not None:
+            self.idle_deadline.cancel()
+            self.idle_deadline = None
+
+    def __launcher_idle(self):
+        self.idle_deadline = None
+        if self.games or self.dead:
+            return
+
+        self.logger.info(f'Launcher [{self.name}] has been idle for {self.config.launcher_idle_timeout} seconds, marked as dead')
+        self.dead = True
+
+        # hibernate the launcher
+        self.hibernate()
 
         
 
-    # Handle game message for existing game
+    # Handle game message for existing game, queued for the game's consumer
     async def game_message(self, channel_id, user_id, msg):
-        pass
+        instance = self.get_game(channel_id)
+        if instance is None:
+            return
+
+        instance.last_active = time.monotonic()
+        if not instance.input.put(user_id, msg):
+            self.logger.debug(f'Game in channel {channel_id} dropped a message from {user_id} (queue: {len(instance.input)})')
     
     # Hibernate this launcher
     def hibernate(self):
         self.logger.info(f'Launcher [{self.name}] hibernating')
 
+        for timer in self.timers:
+            self.scheduler.cancel(timer)
+        self.timers = []
+        self.last_tick = None
+        self.__cancel_idle()
+
         self.events.off('minute', self._every_minute)
         self.events.off('second', self._every_second)
 
@@ -195,10 +333,31 @@ class DiscLauncher:
     def wake(self):
         self.logger.info(f'Launcher [{self.name}] waking up')
 
-        self.loop = asyncio.create_task(self.update_loop())
+        # register ticks with the shared scheduler
+        if not self.timers:
+            self.timers = [
+                self.scheduler.every(1, self._tick_second),
+                self.scheduler.every(60, self._tick_minute)
+            ]
         self.events.on('minute', self._every_minute)
         self.events.on('second', self._every_second)
 
-        self.idle_time = -1
         self.restart_time = datetime.now()
-        self.dead = False
\ No newline at end of file
+        self.dead = False
+
+        # an empty launcher starts counting down to hibernation
+        if not self.games:
+            self.__arm_idle()
+
+    # Drop everything this launcher holds before it is pooled or discarded
+    def clean(self):
+        self.hibernate()
+        self.events.clear()
+        self.games = {}
+        self.bot = None
+        self.running = False
+
+    # Approximate bytes held by this launcher, process-wide objects its games reach are excluded
+    def footprint(self):
+        shared = (self.bot, self.config, self.scheduler, self.logger, self.deadlines, Outbound(), WorkerPool(), self.metrics)
+        return deep_sizeof(self, skip=shared + tuple(self.metrics.metrics.values()))
\ No newline at end of file
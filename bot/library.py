@@ -0,0 +1,80 @@
+
+# Game library entries - import game modules on first use
+
+import os, sys, time, importlib
+
+from bot.exceptions import GameLoadError
+from bot.tools.util import file_signature, signature_changed
+
+class GameEntry(dict):
+    '''Library entry from games.json, the game class is imported on first load()'''
+
+    def __init__(self, entry, lib_path) -> None:
+        super().__init__(entry)
+        self.lib_path = lib_path
+        self.object_file, self.object_class = entry['class'].strip().split('.')[:2]
+        self.module_name = f'{entry["path"]}.{self.object_file}'
+        self.source_file = f'{os.path.join(lib_path, entry["path"], self.object_file)}.py'
+        self.signature = None       # source file signature when last imported
+        self.import_time = None     # seconds spent importing, None until loaded
+
+    @property
+    def loaded(self):
+        return 'object' in self
+
+    # Import the game module and return its DiscGame class
+    def load(self):
+        if 'object' in self:
+            return self['object']
+
+        # check that the game's path exists
+        if not os.path.isdir(os.path.join(self.lib_path, self['path'])):
+            raise GameLoadError(f'Game ({self["ref"]}) path not found: {self["path"]}')
+
+        # check for the game's object file
+        if not os.path.isfile(self.source_file):
+            raise GameLoadError(f'Game ({self["ref"]}) object file not found: {self.object_file}')
+
+        # attempt to load the game path and object
+        return self.__import(importlib.import_module, self.module_name)
+
+    # Source changed since the module was imported
+    def stale(self):
+        if 'object' not in self:
+            return False
+        return signature_changed(self.signature, file_signature(self.source_file, self.signature))
+
+    # Re-import a changed module, running games keep the class they were created with
+    def reload(self):
+        if self.module_name not in sys.modules:
+            self.pop('object', None)
+            return self.load()
+        return self.__import(importlib.reload, sys.modules[self.module_name])
+
+    # Same games.json entry, so an already imported class can be kept
+    def matches(self, entry, lib_path):
+        return self.lib_path == lib_path and {key: value for key, value in self.items() if key != 'object'} == entry
+
+    def __import(self, importer, module):
+        signature = file_signature(self.source_file)
+        start = time.perf_counter()
+        try:
+            module = importer(module)
+        except Exception as e:
+            raise GameLoadError(f'Game ({self["ref"]}) module could not be loaded: {str(e)}')
+        self.import_time = time.perf_counter() - start
+
+        # grab the entry DiscGame object
+        if not hasattr(module, self.object_class):
+            raise GameLoadError(f'Game ({self["ref"]}) object could not be found: {self.object_class}')
+
+        self['object'] = getattr(module, self.object_class)
+        self.signature = signature
+        return self['object']
+
+
+# Import times of loaded games, slowest first: [(ref, module, seconds)]
+def import_report(game_lib):
+    loaded = [entry for entry in game_lib.values() if entry.import_time is not None]
+    loaded.sort(key=lambda entry: entry.import_time, reverse=True)
+    return [(entry['ref'], entry.module_name, entry.import_time) for entry in loaded]
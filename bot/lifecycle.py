@@ -0,0 +1,84 @@
+
+# Launcher lifecycle - hand out launchers per guild, reap dead ones and pool them for reuse
+
+import logging
+
+from .launcher import DiscLauncher
+from .tools.scheduler import Scheduler
+from .config import Config
+
+
+class LauncherManager:
+    '''Owns every guild's DiscLauncher, bounded by evicting dead launchers'''
+
+    def __init__(self, pool_size=8) -> None:
+        self.config = Config()
+        self.logger = logging.getLogger(self.config.log_name)
+
+        self.launchers = {} # guild_id: DiscLauncher
+        self.pool = []      # cleaned launchers waiting for a guild
+        self.pool_size = pool_size
+        self.timer = None
+
+        # stats
+        self.created = 0
+        self.reused = 0
+        self.reaped = 0
+
+    # Launcher for a guild, reusing a pooled one before building a new one
+    def get(self, bot, guild_id, name) -> DiscLauncher:
+        launcher = self.launchers.get(guild_id)
+        if launcher is not None:
+            return launcher
+
+        if self.pool:
+            launcher = self.pool.pop()
+            launcher.reset(bot, name)
+            self.reused += 1
+        else:
+            launcher = DiscLauncher(bot, name)
+            self.created += 1
+
+        self.launchers[guild_id] = launcher
+        return launcher
+
+    # Sweep for dead launchers every interval seconds
+    def start(self, interval):
+        if self.timer is None and interval > 0:
+            self.timer = Scheduler().every(interval, self.sweep)
+
+    def stop(self):
+        Scheduler().cancel(self.timer)
+        self.timer = None
+
+    # Evict dead launchers without games, their events and timers go with them
+    def sweep(self):
+        for guild_id, launcher in list(self.launchers.items()):
+            if not launcher.dead or launcher.games:
+                continue
+
+            self.logger.debug(f'Found dead launcher [{launcher.name}], evicting')
+            del self.launchers[guild_id]
+            launcher.clean()
+            self.reaped += 1
+
+            if len(self.pool) < self.pool_size:
+                self.pool.append(launcher)
+
+        # measuring walks every launcher, only worth it when someone reads it
+        if self.logger.isEnabledFor(logging.DEBUG):
+            stats = self.stats()
+            self.logger.debug(f'Launchers: {stats["launchers"]} active ({stats["dead"]} dead), {stats["pooled"]} pooled, ~{stats["bytes"] / 1024:.1f} KiB')
+
+    def stats(self):
+        footprints = {guild_id: launcher.footprint() for guild_id, launcher in self.launchers.items()}
+        return {
+            'launchers': len(self.launchers),
+            'dead': sum(launcher.dead for launcher in self.launchers.values()),
+            'pooled': len(self.pool),
+            'created': self.created,
+            'reused': self.reused,
+            'reaped': self.reaped,
+            'bytes': sum(footprints.values()),
+            'bytes_per_launcher': footprints
+        }
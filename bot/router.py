@@ -0,0 +1,92 @@
+
+# Command router - lookup tables built once per config snapshot
+
+import time
+
+PERMISSION_ANY = 'any'
+
+# Cached members per guild before expired entries are pruned
+ROLE_CACHE_PRUNE = 1024
+
+
+class RoleCache:
+    '''Member role sets per guild, rebuilt after ttl seconds'''
+
+    def __init__(self, ttl=60.0) -> None:
+        self.ttl = ttl
+        self.guilds = {} # guild_id: {member_id: (expires, frozenset of role ids and names)}
+
+    def roles(self, member):
+        members = self.guilds.get(member.guild.id)
+        if members is None:
+            members = self.guilds[member.guild.id] = {}
+
+        now = time.monotonic()
+        cached = members.get(member.id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        # drop expired members before the guild's cache grows past its active members
+        if len(members) >= ROLE_CACHE_PRUNE:
+            for member_id in [member_id for member_id, (expires, _) in members.items() if expires <= now]:
+                del members[member_id]
+
+        roles = frozenset(role.id for role in member.roles) | frozenset(role.name for role in member.roles)
+        members[member.id] = (now + self.ttl, roles)
+        return roles
+
+    def invalidate(self, guild_id, member_id=None):
+        if member_id is None:
+            self.guilds.pop(guild_id, None)
+        elif guild_id in self.guilds:
+            self.guilds[guild_id].pop(member_id, None)
+
+
+class CommandRouter:
+    '''Prefix, alias, whitelist and permission lookups for one config snapshot'''
+
+    def __init__(self, prefix, commands, whitelist, use_aliases=True, use_whitelist=True, permissions=None, owners=(), role_ttl=60.0) -> None:
+        self.prefix = prefix
+        self.use_whitelist = use_whitelist
+
+        # command or alias: command
+        self.table = {}
+        for command, info in commands.items():
+            self.table[command] = command
+            if use_aliases:
+                for alias in info['aliases']:
+                    self.table.setdefault(alias, command)
+
+        # command: permission, commands missing from commands.json are open to anyone
+        self.permissions = {command: info['permission'] for command, info in commands.items()}
+
+        # permission: role ids and names that grant it
+        self.grants = {name: frozenset(roles) for name, roles in (permissions or {}).items()}
+        self.owners = frozenset(owners)
+
+        # whitelist entries are guild ids, or guild names from older whitelist files
+        entries = [entry for entry in whitelist if entry]
+        self.whitelist_ids = frozenset(int(entry) for entry in entries if entry.isdigit())
+        self.whitelist_names = frozenset(entry for entry in entries if not entry.isdigit())
+
+        self.role_cache = RoleCache(role_ttl)
+
+    # Aliases of a command, for registering with the bot
+    def aliases(self, command):
+        return [alias for alias, target in self.table.items() if target == command and alias != command]
+
+    def is_command(self, content):
+        return content.lstrip().startswith(self.prefix)
+
+    def allowed_guild(self, guild):
+        return not self.use_whitelist or guild.id in self.whitelist_ids or guild.name in self.whitelist_names
+
+    def allowed(self, command, member):
+        permission = self.permissions.get(command, PERMISSION_ANY)
+        if permission == PERMISSION_ANY or member.id in self.owners:
+            return True
+
+        grants = self.grants.get(permission)
+        if not grants:
+            return False
+        return not grants.isdisjoint(self.role_cache.roles(member))
@@ -8,16 +8,22 @@ from dotenv import load_dotenv
 
 from bot.tools.util import path_resolve
 from bot.tools import events
+from bot.tools import store
+from bot.tools.workers import WorkerPool
+from bot.tools.deletions import DeletionQueue
+from bot.tools.metrics import MetricsServer
 from .exceptions import ConfigLoadError
 from .commands import Games, GamesHelp
 from .config import Config
+from .supervisor import Supervisor
 
 class Runner:
 
     def __init__(self) -> None:
         pass
 
-    def run(self):
+    # Run the bot, or only the given gateway shards when started by the supervisor
+    def run(self, shard_ids=None, shard_count=None, index=None):
 
         # first (and only) config instance
         try:
@@ -27,11 +33,19 @@ class Runner:
             return 1
 
         # first-time logger setup
-        logger = self.__get_logger(config.log_name, level=config.log_level, showname=config.log_showname, stdout=config.stdout)
+        label = f'shards {",".join(map(str, shard_ids))}' if shard_ids is not None else None
+        logger = self.__get_logger(config.log_name, level=config.log_level, showname=config.log_showname, stdout=config.stdout, label=label)
     
         logger.info('Starting...')
         logger.info(f'Loaded games: {", ".join(config.game_lib.keys())}')
 
+        # load persistent storage, shared between shard processes only with the sqlite engine
+        os.makedirs(config.storage_dir, exist_ok=True)
+        store.setDir(os.path.join(config.storage_dir, ''))
+        store.setFormat(config.storage_format, compress=config.storage_compress)
+        store.setEngine(config.storage_engine, lazy=config.storage_lazy, cacheSize=config.storage_cache_size)
+        store.load()
+
         logger.debug('Creating bot...')
 
         # environment variables
@@ -39,33 +53,83 @@ class Runner:
         token = os.getenv('BOT_TOKEN')
 
         # create bot
-        bot = commands.Bot(command_prefix=config.bot_prefix, help_command=GamesHelp())
+        if shard_ids is not None:
+            bot = commands.AutoShardedBot(command_prefix=config.bot_prefix, help_command=GamesHelp(), shard_ids=shard_ids, shard_count=shard_count)
+        else:
+            bot = commands.Bot(command_prefix=config.bot_prefix, help_command=GamesHelp())
         bot.add_cog(Games(bot))
 
         # run bot coroutines
         loop = asyncio.get_event_loop()
+
+        # metrics listener, one port per shard process
+        metrics_server = None
+        if config.metrics_port > 0:
+            metrics_server = MetricsServer(config.metrics_host, config.metrics_port + (index or 0), logger=logger)
+            try:
+                loop.run_until_complete(metrics_server.start())
+            except OSError as e:
+                logger.error(f'Could not serve metrics: {str(e)}')
+                metrics_server = None
+
         try:
+            code = 0
             logger.info(f'Waking up bot with prefix \'{config.bot_prefix}\'...')
             loop.run_until_complete(bot.start(token))
 
         # signal interrupts should kill it
         except KeyboardInterrupt:
             logger.debug('Signal to stop bot!')
+            loop.run_until_complete(DeletionQueue().flush())
             loop.run_until_complete(bot.close())
 
         # anything else unknown
         except Exception as e:
             logger.error(f'Exception: {str(e)}')
+            code = 1
+
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.stop())
+
+        # write out storage changes that have not been flushed yet
+        loop.run_until_complete(store.stopFlusher())
+
+        # stop game worker processes
+        WorkerPool().shutdown()
 
         # close and exit
         logger.debug('Closed bot and event loop.')
         logger.info('Exiting.\n\n')
 
-        return 0
+        return code
+
+    # Run the configured shards in supervised worker processes
+    def run_sharded(self):
+
+        try:
+            config = Config()
+        except ConfigLoadError as e:
+            print(f'Issue loading config!  {str(e)}')
+            return 1
+
+        logger = self.__get_logger(config.log_name, level=config.log_level, showname=config.log_showname, stdout=config.stdout, label='supervisor')
+
+        # file engines belong to one process, and guilds move between processes when shards are regrouped
+        if config.shard_processes > 1 and config.storage_engine != store.ENGINE_SQLITE:
+            logger.error(f'Running shards in {config.shard_processes} processes needs [storage] engine=sqlite, not {config.storage_engine}')
+            return 1
+
+        # each process's item cache would keep serving values the other processes have since changed
+        if config.shard_processes > 1 and config.storage_cache_size > 0:
+            logger.error(f'Running shards in {config.shard_processes} processes needs [storage] cache_size=0, not {config.storage_cache_size}')
+            return 1
+
+        supervisor = Supervisor(config.shard_count, config.shard_processes, restart_delay=config.shard_restart_delay, logger=logger)
+        return supervisor.run()
 
 
     # Create logger and configure
-    def __get_logger(self, name, level=logging.INFO, showname=False, stdout=True):
+    def __get_logger(self, name, level=logging.INFO, showname=False, stdout=True, label=None):
         logger = logging.getLogger(name)
         logger.setLevel(level)
 
@@ -73,10 +137,12 @@ class Runner:
         console_handle.setLevel(logging.DEBUG)
         file_handle = logging.FileHandler(path_resolve('out.log', force_exists=False), encoding='utf-8')
 
+        # shard processes share the log file, tag their lines
+        prefix = f'({label}) ' if label is not None else ''
         if showname:
-            formatter = logging.Formatter('%(asctime)s - %(name)s [%(levelname)s] |   %(message)s')
+            formatter = logging.Formatter(f'%(asctime)s - %(name)s [%(levelname)s] |   {prefix}%(message)s')
         else:
-            formatter = logging.Formatter('%(asctime)s [%(levelname)s] |   %(message)s')
+            formatter = logging.Formatter(f'%(asctime)s [%(levelname)s] |   {prefix}%(message)s')
         console_handle.setFormatter(formatter)
         file_handle.setFormatter(formatter)
 
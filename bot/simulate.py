@@ -0,0 +1,368 @@
+
+# Headless simulation - drive the Games cog against an in-process fake Discord
+
+import os, time, json, random, asyncio, logging, argparse, itertools, resource, tempfile, functools
+
+from types import SimpleNamespace
+
+import discord
+
+from .tools.scheduler import Scheduler
+from .tools.outbound import Outbound
+from .tools.deletions import DeletionQueue, DISCORD_EPOCH
+from .tools import store
+from .config import Config
+from .supervisor import Supervisor, shard_for
+from .exceptions import ConfigLoadError
+
+WORDS = ['guess', 'hello', 'left', 'right', 'up', 'down', 'pass', 'a', 'e', 'z', '42', '7']
+
+
+# ===========================================
+# Fake Discord layer
+class FakeREST:
+    '''Latency, injected errors and rate limits for every fake Discord call'''
+
+    def __init__(self, latency=0.05, jitter=0.5, error_rate=0.0, ratelimit_rate=0.0, retry_after=1.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.ratelimit_rate = ratelimit_rate
+        self.retry_after = retry_after
+
+        self.ids = itertools.count()
+        self.calls = {} # call: count
+        self.errors = 0
+        self.ratelimited = 0
+
+    # Snowflake for right now, so message ages come out right
+    def snowflake(self):
+        return ((int(time.time() * 1000) - DISCORD_EPOCH) << 22) + (next(self.ids) & 0x3fffff)
+
+    async def call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+        # discord.py waits out 429s itself, the caller only sees the delay
+        if random.random() < self.ratelimit_rate:
+            self.ratelimited += 1
+            await asyncio.sleep(self.retry_after)
+
+        await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise discord.HTTPException(SimpleNamespace(status=500, reason='Simulated failure'), f'{name} failed')
+
+
+class FakeMessage:
+
+    def __init__(self, rest, channel, author, content) -> None:
+        self.rest = rest
+        self.id = rest.snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+
+    async def edit(self, **kwargs):
+        await self.rest.call('edit')
+        self.content = kwargs.get('content', self.content)
+
+    async def delete(self):
+        await self.rest.call('delete')
+
+
+class FakeChannel:
+
+    def __init__(self, rest, guild, channel_id, name) -> None:
+        self.rest = rest
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.gateway = None         # receives messages sent here, like the gateway would
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.call('send')
+        message = FakeMessage(self.rest, self, self.guild.me, content)
+        if self.gateway is not None:
+            self.gateway(message)
+        return message
+
+    async def delete_messages(self, messages):
+        await self.rest.call('bulk_delete' if len(messages) > 1 else 'delete')
+
+    async def history(self, limit=None):
+        await self.rest.call('history')
+        return
+        yield
+
+
+class FakeMember:
+
+    def __init__(self, guild, user_id, name) -> None:
+        self.guild = guild
+        self.id = user_id
+        self.name = name
+        self.roles = []
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id, name, bot_user) -> None:
+        self.id = guild_id
+        self.name = name
+        self.me = FakeMember(self, bot_user.id, bot_user.name)
+
+
+class FakeBot:
+
+    def __init__(self) -> None:
+        self.user = SimpleNamespace(id=1, name='simulated-bot')
+        self.channels = {} # channel_id: FakeChannel
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_command(self, name):
+        return None
+
+
+class FakeContext:
+    '''Just enough of commands.Context for the Games commands'''
+
+    def __init__(self, bot, channel, author, command, content) -> None:
+        self.bot = bot
+        self.guild = channel.guild
+        self.channel = channel
+        self.author = author
+        self.command = command
+        self.message = SimpleNamespace(content=content, author=author)
+
+    async def send(self, content):
+        return await self.channel.send(content)
+
+
+# ===========================================
+# Simulation
+class Simulation:
+    '''N guilds x M games, each with synthetic players, run for a fixed duration'''
+
+    def __init__(self, args, shard_ids=None, shard_count=None) -> None:
+        self.args = args
+        self.shard_ids = shard_ids      # only guilds on these shards are simulated, all if None
+        self.shard_count = shard_count
+        self.config = Config()
+        self.rest = FakeREST(args.latency / 1000, error_rate=args.errors, ratelimit_rate=args.ratelimits)
+        self.bot = FakeBot()
+
+        self.tick_lag = []          # seconds each scheduler tick ran late
+        self.loop_lag = []          # seconds a short sleep overshot
+        self.task_counts = []
+        self.start_failures = 0
+        self.messages = 0
+        self.gateway_tasks = set()
+
+    async def run(self):
+        from .commands import Games
+
+        # guild names don't matter here, and saved stats go somewhere throwaway
+        self.config.router.use_whitelist = False
+        store.setDir(os.path.join(tempfile.mkdtemp(prefix='disc-simulate-'), ''))
+        store.setEngine(store.ENGINE_JSON)
+        store.load()
+
+        self.cog = Games(self.bot)
+        self.commands = {command.name: command for command in self.cog.get_commands()}
+        await self.cog.on_ready()
+
+        refs = self.args.game or list(self.config.game_lib.keys())
+        channels = self.__build(refs)
+
+        probes = [
+            asyncio.get_running_loop().create_task(self.__probe_loop()),
+            asyncio.get_running_loop().create_task(self.__probe_tasks())
+        ]
+        tick_timer = Scheduler().every(1, self.__probe_tick, [time.monotonic()])
+
+        # start every game, then let the players loose
+        started = time.monotonic()
+        for channel, ref in channels:
+            try:
+                await self.__command('play', channel, channel.players[0], ref)
+            except Exception as e:
+                self.start_failures += 1
+                logging.getLogger(self.config.log_name).warning(f'Simulated game \'{ref}\' failed to start: {type(e).__name__}: {e}')
+
+        players = [
+            asyncio.get_running_loop().create_task(self.__player(channel, player))
+            for channel, _ in channels for player in channel.players
+        ]
+        await asyncio.sleep(self.args.duration)
+
+        for task in players:
+            task.cancel()
+        for channel, _ in channels:
+            await self.__command('end', channel, channel.players[0])
+        await DeletionQueue().flush()
+        elapsed = time.monotonic() - started
+
+        Scheduler().cancel(tick_timer)
+        for task in probes:
+            task.cancel()
+        self.cog.lifecycle.stop()
+
+        return self.report(elapsed, channels)
+
+    def report(self, elapsed, channels):
+        def percentile(values, p):
+            values = sorted(values)
+            return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+        return {
+            'guilds': len({channel.guild.id for channel, _ in channels}),
+            'games': len(channels),
+            'players': len(channels) * self.args.players,
+            'seconds': elapsed,
+            'start_failures': self.start_failures,
+            'player_messages': self.messages,
+            'tick_lag_p50': percentile(self.tick_lag, 0.5),
+            'tick_lag_p99': percentile(self.tick_lag, 0.99),
+            'tick_lag_max': max(self.tick_lag, default=0.0),
+            'loop_lag_p50': percentile(self.loop_lag, 0.5),
+            'loop_lag_p99': percentile(self.loop_lag, 0.99),
+            'loop_lag_max': max(self.loop_lag, default=0.0),
+            'edits': self.rest.calls.get('edit', 0),
+            'edits_per_second': self.rest.calls.get('edit', 0) / elapsed,
+            'rest_calls': dict(self.rest.calls),
+            'rest_errors': self.rest.errors,
+            'rest_ratelimited': self.rest.ratelimited,
+            'outbound_shed': Outbound().stats()['shed'],
+            'tasks_max': max(self.task_counts, default=0),
+            'tasks_end': len(asyncio.all_tasks()),
+            'rss_kib': rss_kib(),
+            'rss_max_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+
+    # ===========================================
+    # Internals
+    def __build(self, refs):
+        channels = []
+        for g in range(self.args.guilds):
+
+            # snowflake-shaped ids, so guilds spread over shards like real ones
+            guild = FakeGuild((1000 + g) << 22, f'sim-guild-{g}', self.bot.user)
+            if self.shard_ids is not None and shard_for(guild.id, self.shard_count) not in self.shard_ids:
+                continue
+
+            for m in range(self.args.games):
+                channel_id = guild.id * 1000 + m
+                channel = self.bot.channels[channel_id] = FakeChannel(self.rest, guild, channel_id, f'sim-{g}-{m}')
+                channel.gateway = self.__dispatch
+                channel.players = [FakeMember(guild, 10 ** 6 + channel_id * 100 + p, f'player-{p}') for p in range(self.args.players)]
+                channels.append((channel, refs[(g * self.args.games + m) % len(refs)]))
+        return channels
+
+    async def __command(self, name, channel, author, *args):
+        content = ' '.join((self.config.bot_prefix + name,) + args)
+        ctx = FakeContext(self.bot, channel, author, self.commands[name], content)
+        await self.commands[name].callback(self.cog, ctx, *args)
+
+    # Messages reach the cog like gateway events, on their own task
+    def __dispatch(self, message):
+        task = asyncio.get_running_loop().create_task(self.cog.on_message(message))
+        self.gateway_tasks.add(task)
+        task.add_done_callback(self.gateway_tasks.discard)
+
+    async def __player(self, channel, player):
+        while True:
+            await asyncio.sleep(random.expovariate(1 / self.args.message_interval))
+            self.messages += 1
+            self.__dispatch(FakeMessage(self.rest, channel, player, random.choice(WORDS)))
+
+    def __probe_tick(self, last):
+        now = time.monotonic()
+        self.tick_lag.append(max(0.0, now - last[0] - 1))
+        last[0] = now
+
+    async def __probe_loop(self, interval=0.05):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.monotonic() - start - interval)
+
+    async def __probe_tasks(self):
+        while True:
+            self.task_counts.append(len(asyncio.all_tasks()))
+            await asyncio.sleep(1)
+
+
+# Current resident set size
+def rss_kib():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='run.py --simulate', description='Soak test the bot against a fake Discord')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--games', type=int, default=3, help='games per guild')
+    parser.add_argument('--players', type=int, default=4, help='players per game')
+    parser.add_argument('--game', action='append', help='game ref to run, repeatable (default: whole library)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to run')
+    parser.add_argument('--message-interval', type=float, default=2.0, help='mean seconds between messages per player')
+    parser.add_argument('--latency', type=float, default=50.0, help='mean REST latency in ms')
+    parser.add_argument('--errors', type=float, default=0.0, help='fraction of REST calls that fail')
+    parser.add_argument('--ratelimits', type=float, default=0.0, help='fraction of REST calls that hit a rate limit')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', default=None, help='also write the report to this file (one per process when sharded)')
+    parser.add_argument('--sharded', action='store_true', help='run the simulation in supervised shard processes')
+    parser.add_argument('--shards', type=int, default=2, help='shard count when sharded')
+    parser.add_argument('--processes', type=int, default=2, help='shard processes when sharded')
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def simulate(args, shard_ids=None, shard_count=None, index=None):
+    try:
+        config = Config()
+    except ConfigLoadError as e:
+        print(f'Issue loading config!  {str(e)}')
+        return 1
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] |   %(message)s')
+    logging.getLogger(config.log_name).setLevel(logging.WARNING)
+    random.seed(args.seed if index is None or args.seed is None else args.seed + index)
+
+    report = asyncio.run(Simulation(args, shard_ids, shard_count).run())
+
+    lines = [f'{key:>18}: {value:.4f}' if isinstance(value, float) else f'{key:>18}: {value}' for key, value in report.items()]
+    if index is not None:
+        lines.insert(0, f'Shard process {index}, shards {shard_ids}')
+    print('\n'.join(lines), flush=True)
+
+    if args.json:
+        with open(args.json if index is None else f'{args.json}.{index}', 'w') as file:
+            json.dump(report, file, indent=4)
+
+    return 0
+
+
+# Shard process entry point, the guilds each process simulates follow Discord's shard mapping
+def simulate_shards(argv, index, shard_ids, shard_count):
+    raise SystemExit(simulate(parse_args(argv), shard_ids, shard_count, index))
+
+
+def main(argv):
+    args = parse_args(argv)
+    if not args.sharded:
+        return simulate(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] |   %(message)s')
+    supervisor = Supervisor(args.shards, args.processes, target=functools.partial(simulate_shards, argv), restart_clean=False)
+    return supervisor.run()
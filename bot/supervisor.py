@@ -0,0 +1,140 @@
+
+# Supervisor - run groups of gateway shards in worker processes, restart them when they die
+
+import time, signal, logging, multiprocessing
+
+# Discord allows one shard IDENTIFY per 5 seconds
+IDENTIFY_INTERVAL = 5.0
+
+# A shard process that stays up this long resets its restart backoff
+STABLE_UPTIME = 60.0
+
+
+# Discord's guild to shard mapping, guilds (and their launchers) live in the process owning the shard
+def shard_for(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
+
+# Spread shard ids over processes: [[shard_id, ...] per process]
+def partition(shard_count, processes):
+    processes = max(1, min(processes, shard_count))
+    return [list(range(i, shard_count, processes)) for i in range(processes)]
+
+
+# Worker process entry point
+def run_shards(index, shard_ids, shard_count):
+    from bot.runner import Runner
+
+    # the supervisor stops shards with SIGTERM, shut down like an interrupt so storage is flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    raise SystemExit(Runner().run(shard_ids=shard_ids, shard_count=shard_count, index=index))
+
+
+class ShardProcess:
+    '''One worker process and the shards it owns'''
+
+    def __init__(self, index, shard_ids) -> None:
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started_at = 0
+        self.restarts = 0
+        self.restart_delay = 0
+        self.restart_at = None      # monotonic time of the pending restart
+        self.finished = False       # exited cleanly and not restarted
+
+
+class Supervisor:
+    '''Start one process per shard group and keep them running'''
+
+    def __init__(self, shard_count, processes, restart_delay=5.0, max_restart_delay=300.0, target=run_shards, restart_clean=True, logger=None) -> None:
+        self.shard_count = shard_count
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.target = target
+        self.restart_clean = restart_clean  # restart processes that exit with code 0 too
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.context = multiprocessing.get_context('spawn')
+        self.shards = [ShardProcess(i, shard_ids) for i, shard_ids in enumerate(partition(shard_count, processes))]
+        self.stopping = False
+
+    def run(self, poll=1.0) -> int:
+        self.logger.info(f'Supervising {self.shard_count} shards in {len(self.shards)} processes')
+        try:
+            for shard in self.shards:
+                # stagger identifies across processes
+                if shard.index > 0:
+                    time.sleep(IDENTIFY_INTERVAL * len(self.shards[shard.index - 1].shard_ids))
+                self.__start(shard)
+
+            while not self.stopping and not all(shard.finished for shard in self.shards):
+                self.check()
+                time.sleep(poll)
+
+        except KeyboardInterrupt:
+            self.logger.debug('Signal to stop shards!')
+
+        self.stop()
+        return 0
+
+    # Restart processes that exited, backing off when they keep crashing
+    def check(self):
+        now = time.monotonic()
+        for shard in self.shards:
+            if shard.restart_at is not None:
+                if now >= shard.restart_at:
+                    self.__start(shard)
+                continue
+
+            if shard.finished or shard.process is None or shard.process.is_alive():
+                continue
+
+            code = shard.process.exitcode
+            if code == 0 and not self.restart_clean:
+                self.logger.info(f'Shard process {shard.index} {shard.shard_ids} finished')
+                shard.finished = True
+                continue
+            if now - shard.started_at >= STABLE_UPTIME:
+                shard.restart_delay = self.restart_delay
+            else:
+                shard.restart_delay = min(self.max_restart_delay, max(self.restart_delay, shard.restart_delay * 2))
+
+            self.logger.error(f'Shard process {shard.index} {shard.shard_ids} exited with code {code}, restarting in {shard.restart_delay:.1f}s')
+            shard.restart_at = now + shard.restart_delay
+
+    def stop(self, timeout=10.0):
+        self.stopping = True
+        for shard in self.shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.process.terminate()
+        for shard in self.shards:
+            if shard.process is not None:
+                shard.process.join(timeout)
+                if shard.process.is_alive():
+                    shard.process.kill()
+
+    def stats(self):
+        return [
+            {
+                'index': shard.index,
+                'shards': shard.shard_ids,
+                'alive': shard.process is not None and shard.process.is_alive(),
+                'restarts': shard.restarts
+            }
+            for shard in self.shards
+        ]
+
+    def __start(self, shard: ShardProcess):
+        if shard.process is not None:
+            shard.restarts += 1
+            shard.process.close()
+
+        shard.process = self.context.Process(
+            target=self.target,
+            args=(shard.index, shard.shard_ids, self.shard_count),
+            name=f'shards-{shard.index}'
+        )
+        shard.process.start()
+        shard.started_at = time.monotonic()
+        shard.restart_at = None
+        self.logger.info(f'Started shard process {shard.index} (pid {shard.process.pid}) with shards {shard.shard_ids}')
@@ -0,0 +1,86 @@
+
+import asyncio, time, logging
+
+import discord
+
+from bot.tools.util import Singleton
+
+# Discord bulk deletes take 2 to 100 messages, none older than 14 days
+BULK_MAX = 100
+BULK_MAX_AGE = 14 * 24 * 60 * 60 - 60  # seconds, with a minute of slack
+DISCORD_EPOCH = 1420070400000           # ms, snowflake timestamps count from here
+
+
+# Seconds since a message was created, read from its snowflake id
+def message_age(message_id):
+    return time.time() - ((message_id >> 22) + DISCORD_EPOCH) / 1000
+
+
+class DeletionQueue(metaclass=Singleton):
+    '''Per-channel queues of messages to delete, flushed in bulk every interval seconds'''
+
+    def __init__(self, interval=1.0, outbound=None, logger=None) -> None:
+        self.interval = interval
+        self.outbound = outbound
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.channels = {} # channel_id: (channel, [message ids])
+        self.tasks = set()
+
+        # stats
+        self.deleted = 0
+        self.calls = 0
+
+    # Queue a message for deletion, returns immediately
+    def add(self, message):
+        channel = message.channel
+        if channel.id not in self.channels:
+            self.channels[channel.id] = (channel, [])
+            asyncio.get_running_loop().call_later(self.interval, self.__flush_later, channel.id)
+        self.channels[channel.id][1].append(message.id)
+
+    # Delete everything queued now
+    async def flush(self):
+        await asyncio.gather(*(self.__flush(channel_id) for channel_id in list(self.channels)))
+
+    def stats(self):
+        return {
+            'queued': sum(len(ids) for _, ids in self.channels.values()),
+            'deleted': self.deleted,
+            'calls': self.calls
+        }
+
+    # ===========================================
+    # Internals
+    def __flush_later(self, channel_id):
+        task = asyncio.get_running_loop().create_task(self.__flush(channel_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def __flush(self, channel_id):
+        if channel_id not in self.channels:
+            return
+        channel, message_ids = self.channels.pop(channel_id)
+
+        # messages past the bulk window have to go one at a time
+        bulk = [message_id for message_id in message_ids if message_age(message_id) < BULK_MAX_AGE]
+        single = [message_id for message_id in message_ids if message_age(message_id) >= BULK_MAX_AGE]
+
+        batches = [bulk[i:i + BULK_MAX] for i in range(0, len(bulk), BULK_MAX)]
+        batches += [[message_id] for message_id in single]
+
+        for batch in batches:
+            try:
+                await self.__call(channel, channel.delete_messages, [discord.Object(id=message_id) for message_id in batch])
+                self.deleted += len(batch)
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as e:
+                self.logger.warning(f'Could not delete {len(batch)} messages in channel {channel_id}: {str(e)}')
+            self.calls += 1
+
+    async def __call(self, channel, func, *args):
+        if self.outbound is None:
+            return await func(*args)
+        guild_id = channel.guild.id if getattr(channel, 'guild', None) is not None else None
+        return await self.outbound.submit('cleanup', guild_id, ('bulk_delete', channel.id), func, *args)
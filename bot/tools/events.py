@@ -1,44 +1,158 @@
+import asyncio, time, traceback, weakref
+
+class Handler:
+    '''Event callback, classified once when it is registered'''
+
+    __slots__ = ('callback', 'is_coro', 'weak', 'once', '__weakref__')
+
+    def __init__(self, callback, weak=False, once=False, on_dead=None) -> None:
+        self.is_coro = asyncio.iscoroutinefunction(callback)
+        self.weak = weak
+        self.once = once
+
+        if weak:
+            if hasattr(callback, '__self__'):
+                self.callback = weakref.WeakMethod(callback, on_dead)
+            else:
+                self.callback = weakref.ref(callback, on_dead)
+        else:
+            self.callback = callback
+
+    # The callback, or None if a weakly referenced subscriber is gone
+    def resolve(self):
+        return self.callback() if self.weak else self.callback
 
-import asyncio, traceback
 
 class Events:
-    def __init__(self) -> None:
-        self.events = {}
-        self.loop = asyncio.get_event_loop()
+    def __init__(self, logger=None, metrics=None) -> None:
+        self.events = {} # event: [Handler]
+        self.dispatch = {} # event: (Handler, ...) snapshot used by emit
+        self.tasks = set() # in-flight coroutine handlers
+        self.logger = logger
+
+        # time spent in emit per event, coroutine handlers only count until they are scheduled
+        self.dispatch_seconds = None
+        if metrics is not None:
+            self.dispatch_seconds = metrics.histogram('event_dispatch_seconds', 'Seconds spent dispatching an event to its handlers', ('event',))
 
     def emit(self, event, *args, **kwargs):
-        if event not in self.events:
+        handlers = self.dispatch.get(event)
+        if not handlers:
             return
 
-        for callback in list(self.events[event]):
+        start = time.perf_counter()
+        for handler in handlers:
+            callback = handler.callback() if handler.weak else handler.callback
+            if callback is None:
+                continue
+            if handler.once:
+                self.__remove(event, handler)
+
             try:
-                if asyncio.iscoroutinefunction(callback):
-                    self.loop.create_task(callback(*args, **kwargs))
+                if handler.is_coro:
+                    self.__track(event, callback(*args, **kwargs))
                 else:
-                    if callable(callback):
-                        callback(*args, **kwargs)
-            except:
-                traceback.print_exc()
-    
-    def on(self, event, callback):
+                    callback(*args, **kwargs)
+            except Exception as e:
+                self.__report(event, e)
+
+        if self.dispatch_seconds is not None:
+            self.dispatch_seconds.observe(time.perf_counter() - start, event)
+
+    # Run all handlers and wait for them, returns [(callback, seconds, result or exception)]
+    async def emit_gather(self, event, *args, timeout=None, **kwargs):
+        handlers = self.dispatch.get(event)
+        if not handlers:
+            return []
+
+        async def run(handler, callback):
+            start = time.perf_counter()
+            try:
+                result = callback(*args, **kwargs)
+                if handler.is_coro:
+                    result = await asyncio.wait_for(result, timeout)
+            except Exception as e:
+                result = e
+            return callback, time.perf_counter() - start, result
+
+        calls = []
+        for handler in handlers:
+            callback = handler.resolve()
+            if callback is None:
+                continue
+            if handler.once:
+                self.__remove(event, handler)
+            calls.append(run(handler, callback))
+
+        return await asyncio.gather(*calls)
+
+    def on(self, event, callback, weak=False):
+        return self.__add(event, callback, weak=weak)
+
+    def off(self, event, callback):
         if event not in self.events:
-            self.events[event] = []
-        self.events[event].append(callback)
+            return
+        for handler in self.events[event]:
+            if handler.resolve() == callback:
+                self.__remove(event, handler)
+                break
+
         return self
-    
-    def off(self, event, callback):
+
+    def once(self, event, callback, weak=False):
+        return self.__add(event, callback, weak=weak, once=True)
+
+    # Remove every handler, or every handler of one event
+    def clear(self, event=None):
+        if event is None:
+            self.events.clear()
+            self.dispatch.clear()
+        else:
+            self.events.pop(event, None)
+            self.dispatch.pop(event, None)
+        return self
+
+    # ===========================================
+    # Internals
+    def __add(self, event, callback, weak=False, once=False):
         if event not in self.events:
+            self.events[event] = []
+
+        # weakly referenced subscribers remove themselves once collected
+        self_ref = weakref.ref(self)
+        def on_dead(_ref):
+            events = self_ref()
+            if events is not None:
+                events.__remove(event, handler)
+
+        handler = Handler(callback, weak=weak, once=once, on_dead=on_dead if weak else None)
+        self.events[event].append(handler)
+        self.dispatch[event] = tuple(self.events[event])
+        return self
+
+    def __remove(self, event, handler):
+        if event not in self.events or handler not in self.events[event]:
             return
-        self.events[event].remove(callback)
+        self.events[event].remove(handler)
 
-        if not self.events[event]:
+        if self.events[event]:
+            self.dispatch[event] = tuple(self.events[event])
+        else:
             del self.events[event]
+            del self.dispatch[event]
 
-        return self
+    def __track(self, event, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(lambda t: self.__task_done(event, t))
 
-    def once(self, event, callback):
-        def _callback(*args, **kwargs):
-            self.off(event, _callback)
-            return callback(*args, **kwargs)
+    def __task_done(self, event, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.__report(event, task.exception())
 
-        return self.on(event, _callback)
+    def __report(self, source, e):
+        if self.logger is not None:
+            self.logger.error(f'Event handler error [{source}]: {type(e).__name__}: {e}', exc_info=e)
+        else:
+            traceback.print_exception(type(e), e, e.__traceback__)
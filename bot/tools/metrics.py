@@ -0,0 +1,189 @@
+
+# Metrics registry - counters, gauges and histograms served in Prometheus text format
+
+import asyncio, bisect, logging, math
+
+from bot.tools.util import Singleton
+
+# Metric names are prefixed with this
+NAMESPACE = 'disc'
+
+# Histogram buckets in seconds, from a fast event dispatch up to a stalled tick
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''A named metric, one series per combination of label values'''
+
+    type = None
+
+    def __init__(self, name, help, labels=()) -> None:
+        self.name = f'{NAMESPACE}_{name}'
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = {} # label values: value
+
+    # (name suffix, extra labels, label values, value) for every sample
+    def samples(self):
+        for values, value in self.series.items():
+            yield '', (), values, value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {escape(self.help)}', f'# TYPE {self.name} {self.type}']
+        for suffix, extra, values, value in self.samples():
+            pairs = [f'{label}="{escape(v)}"' for label, v in zip(self.labels, values)]
+            pairs += [f'{label}="{escape(v)}"' for label, v in extra]
+            lines.append(f'{self.name}{suffix}{"{" + ",".join(pairs) + "}" if pairs else ""} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()) -> None:
+        super().__init__(name, help, labels)
+
+        # unlabelled counters are exported from the start, at zero
+        if not self.labels:
+            self.series[()] = 0
+
+    def inc(self, *labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''Gauge set directly, or read from func when scraped'''
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None) -> None:
+        super().__init__(name, help, labels)
+        self.func = func            # returns a value, or {label values: value} for labelled gauges
+
+    def set(self, value, *labels):
+        self.series[labels] = value
+
+    def samples(self):
+        if self.func is not None:
+            values = self.func()
+            self.series = values if isinstance(values, dict) else {(): values}
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0] # bucket counts, sum, count
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                yield '_bucket', (('le', format_value(float(bound))),), values, cumulative
+            yield '_sum', (), values, total
+            yield '_count', (), values, count
+
+
+class Metrics(metaclass=Singleton):
+    '''Process-wide metric registry, registering a name twice returns the same metric'''
+
+    def __init__(self) -> None:
+        self.metrics = {} # name: Metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self.__register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), func=None) -> Gauge:
+        gauge = self.__register(Gauge, name, help, labels)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram, name, help, labels, buckets=buckets)
+
+    # Every metric in the Prometheus text exposition format
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+    # ===========================================
+    # Internals
+    def __register(self, cls, name, help, labels, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'metric {name} is already registered as a {metric.type}')
+        return metric
+
+
+class MetricsServer:
+    '''Minimal HTTP listener answering GET /metrics from the registry'''
+
+    def __init__(self, host, port, metrics=None, logger=None) -> None:
+        self.host = host
+        self.port = port
+        self.metrics = metrics or Metrics()
+        self.logger = logger or logging.getLogger(__name__)
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    # ===========================================
+    # Internals
+    async def __handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.metrics.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.warning(f'Metrics request failed: {type(e).__name__}: {e}')
+        finally:
+            writer.close()
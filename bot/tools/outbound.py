@@ -0,0 +1,268 @@
+
+import asyncio, time, traceback
+
+from collections import OrderedDict, deque
+
+from bot.tools.util import Singleton
+
+# Priority classes, lower goes first
+PRIORITIES = {
+    'command': 0,   # replies to user commands
+    'endcard': 1,   # game results, never shed
+    'frame': 2,     # game screen updates, shed under pressure
+    'cleanup': 3    # deleting player messages in game channels, never shed, goes ahead of frames once aged
+}
+PRIORITY_SHED = PRIORITIES['frame']
+PRIORITY_AGED = PRIORITIES['cleanup']
+
+
+class Request:
+    '''A queued outbound Discord call'''
+
+    __slots__ = ('priority', 'guild_id', 'route', 'func', 'args', 'kwargs', 'future', 'queued_at')
+
+    def __init__(self, priority, guild_id, route, func, args, kwargs, future) -> None:
+        self.priority = priority
+        self.guild_id = guild_id
+        self.route = route
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class RouteBucket:
+    '''Token bucket for one rate limit route'''
+
+    __slots__ = ('size', 'period', 'tokens', 'updated')
+
+    def __init__(self, size, period) -> None:
+        self.size = size
+        self.period = period
+        self.tokens = size
+        self.updated = time.monotonic()
+
+    # Seconds until a token is available, 0 if one is available now
+    def wait_time(self, now):
+        self.tokens = min(self.size, self.tokens + (now - self.updated) * self.size / self.period)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.period / self.size
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Outbound(metaclass=Singleton):
+    '''Process-wide scheduler for outbound Discord requests'''
+
+    def __init__(self, rate=50, max_in_flight=20, route_size=5, route_period=5.0, shed_depth=1000, frame_max_wait=5.0, cleanup_max_wait=2.0, metrics=None) -> None:
+        self.global_bucket = RouteBucket(rate, 1.0)
+        self.max_in_flight = max_in_flight
+        self.route_size = route_size
+        self.route_period = route_period
+        self.shed_depth = shed_depth
+        self.frame_max_wait = frame_max_wait
+        self.cleanup_max_wait = cleanup_max_wait
+
+        # per priority: guild_id -> deque of requests, guilds are served round robin
+        self.queues = [OrderedDict() for _ in PRIORITIES]
+        self.routes = {} # route: RouteBucket
+        self.depth = 0
+        self.in_flight = 0
+
+        # stats
+        self.sent = [0] * len(PRIORITIES)
+        self.shed = 0
+        self.wait_total = [0.0] * len(PRIORITIES)
+        self.wait_max = [0.0] * len(PRIORITIES)
+
+        # seconds each call spent with discord, queue wait excluded
+        self.latency = None
+        self.shed_count = None
+        if metrics is not None:
+            self.latency = metrics.histogram('rest_latency_seconds', 'Seconds Discord took to answer a request', ('route',))
+            self.shed_count = metrics.counter('outbound_shed_total', 'Game frames shed by the outbound scheduler')
+
+        self.ready = None
+        self.task = None
+
+    # Apply changed limits to the running scheduler, queued requests are kept
+    def configure(self, rate=None, max_in_flight=None, shed_depth=None, frame_max_wait=None, cleanup_max_wait=None):
+        if rate is not None and rate != self.global_bucket.size:
+            self.global_bucket.size = rate
+            self.global_bucket.tokens = min(self.global_bucket.tokens, rate)
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+        if shed_depth is not None:
+            self.shed_depth = shed_depth
+        if frame_max_wait is not None:
+            self.frame_max_wait = frame_max_wait
+        if cleanup_max_wait is not None:
+            self.cleanup_max_wait = cleanup_max_wait
+        if self.ready is not None:
+            self.ready.set()
+
+    # Queue a call, resolves to the call's result (None if the request was shed)
+    def submit(self, priority, guild_id, route, func, *args, **kwargs) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done():
+            self.ready = asyncio.Event()
+            self.task = loop.create_task(self.__run())
+
+        level = PRIORITIES[priority]
+        request = Request(level, guild_id, route, func, args, kwargs, loop.create_future())
+
+        guilds = self.queues[level]
+        if guild_id not in guilds:
+            guilds[guild_id] = deque()
+        guilds[guild_id].append(request)
+        self.depth += 1
+
+        if self.depth > self.shed_depth:
+            self.__shed_oldest()
+
+        self.ready.set()
+        return request.future
+
+    def stats(self):
+        return {
+            name: {
+                'depth': sum(len(requests) for requests in self.queues[level].values()),
+                'sent': self.sent[level],
+                'wait_avg': self.wait_total[level] / self.sent[level] if self.sent[level] else 0.0,
+                'wait_max': self.wait_max[level]
+            }
+            for name, level in PRIORITIES.items()
+        } | {
+            'in_flight': self.in_flight,
+            'shed': self.shed,
+            'routes': len(self.routes)
+        }
+
+    # ===========================================
+    # Internals
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = None
+            if self.depth > 0 and self.in_flight < self.max_in_flight:
+                request, wait = self.__next(time.monotonic())
+                if request is not None:
+                    self.in_flight += 1
+                    loop.create_task(self.__execute(request))
+                    continue
+
+            self.ready.clear()
+            if wait is None:
+                if self.depth == 0:
+                    self.__prune_routes()
+                await self.ready.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self.ready.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    # Pick the next sendable request, or the time to wait for one
+    def __next(self, now):
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        for level in self.__levels(now):
+            guilds = self.queues[level]
+            for guild_id in list(guilds):
+                requests = guilds[guild_id]
+
+                # drop requests the caller gave up on, and frames that waited too long
+                while requests and (requests[0].future.done() or
+                        (level == PRIORITY_SHED and now - requests[0].queued_at > self.frame_max_wait)):
+                    self.__drop(requests.popleft())
+                if not requests:
+                    del guilds[guild_id]
+                    continue
+
+                request = requests[0]
+                bucket = self.routes.get(request.route)
+                if bucket is None:
+                    bucket = self.routes[request.route] = RouteBucket(self.route_size, self.route_period)
+
+                route_wait = bucket.wait_time(now)
+                if route_wait > 0:
+                    wait = route_wait if wait == 0 else min(wait, route_wait)
+                    continue
+
+                # serve this guild, then move it to the back of the line
+                requests.popleft()
+                if requests:
+                    guilds.move_to_end(guild_id)
+                else:
+                    del guilds[guild_id]
+
+                bucket.take()
+                self.global_bucket.take()
+                self.depth -= 1
+                return request, 0
+
+        return None, wait if wait > 0 else None
+
+    # Strict priority order, except cleanup that waited too long goes ahead of frames so fresh frames can't starve it
+    def __levels(self, now):
+        levels = list(range(len(self.queues)))
+        if any(now - requests[0].queued_at > self.cleanup_max_wait for requests in self.queues[PRIORITY_AGED].values() if requests):
+            levels.remove(PRIORITY_AGED)
+            levels.insert(PRIORITY_SHED, PRIORITY_AGED)
+        return levels
+
+    async def __execute(self, request: Request):
+        waited = time.monotonic() - request.queued_at
+        self.sent[request.priority] += 1
+        self.wait_total[request.priority] += waited
+        self.wait_max[request.priority] = max(self.wait_max[request.priority], waited)
+
+        try:
+            if not request.future.done():
+                start = time.monotonic()
+                try:
+                    result = await request.func(*request.args, **request.kwargs)
+                finally:
+                    if self.latency is not None:
+                        self.latency.observe(time.monotonic() - start, request.route[0])
+                if not request.future.done():
+                    request.future.set_result(result)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+            else:
+                traceback.print_exc()
+        finally:
+            self.in_flight -= 1
+            self.ready.set()
+
+    # Refilled routes behave like new ones, no need to keep them around
+    def __prune_routes(self):
+        now = time.monotonic()
+        for route, bucket in list(self.routes.items()):
+            if bucket.wait_time(now) == 0 and bucket.tokens >= bucket.size:
+                del self.routes[route]
+
+    # Under pressure, shed the oldest frame from the busiest guild
+    def __shed_oldest(self):
+        guilds = self.queues[PRIORITY_SHED]
+        if not guilds:
+            return
+        guild_id = max(guilds, key=lambda guild: len(guilds[guild]))
+        self.__drop(guilds[guild_id].popleft())
+        if not guilds[guild_id]:
+            del guilds[guild_id]
+
+    def __drop(self, request: Request):
+        self.depth -= 1
+        if not request.future.done():
+            self.shed += 1
+            if self.shed_count is not None:
+                self.shed_count.inc()
+            request.future.set_result(None)
@@ -0,0 +1,183 @@
+
+import asyncio, time, traceback
+
+from bot.tools.util import Singleton
+
+# Timing wheel layout: each level has WHEEL_SLOTS buckets, level n covers
+# WHEEL_SLOTS ** (n + 1) ticks (seconds, minutes, hours at the default resolution)
+WHEEL_SLOTS = 60
+WHEEL_LEVELS = 3
+
+
+class Timer:
+    '''Handle for a callback registered with the scheduler'''
+
+    __slots__ = ('callback', 'args', 'interval', 'expires', 'cancelled')
+
+    def __init__(self, callback, args, interval, expires) -> None:
+        self.callback = callback
+        self.args = args
+        self.interval = interval    # ticks between calls, 0 for one-shot timers
+        self.expires = expires      # absolute tick this timer fires on
+        self.cancelled = False
+
+
+class Scheduler(metaclass=Singleton):
+    '''Process-wide hierarchical timing wheel driven by the monotonic clock'''
+
+    def __init__(self, resolution=1.0) -> None:
+        self.resolution = resolution    # seconds per tick
+        self.tick = 0                   # last processed tick
+        self.origin = None              # monotonic time of tick 0
+        self.count = 0                  # live timers in the wheel
+
+        self.wheels = [[[] for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)]
+        self.overflow = []
+
+        self.task = None
+        self.wakeup = None
+        self.sleep_until = None         # tick the run loop is sleeping until
+
+    # ===========================================
+    # Registration
+    # Call callback every interval seconds, aligned to the scheduler tick grid
+    def every(self, interval, callback, *args) -> Timer:
+        ticks = max(1, round(interval / self.resolution))
+        return self.__add(Timer(callback, args, ticks, self.tick + ticks))
+
+    # Call callback once after delay seconds
+    def call_later(self, delay, callback, *args) -> Timer:
+        ticks = max(1, round(delay / self.resolution))
+        return self.__add(Timer(callback, args, 0, self.tick + ticks))
+
+    def cancel(self, timer: Timer):
+        if timer is not None and not timer.cancelled:
+            timer.cancelled = True
+            self.count -= 1
+
+    # ===========================================
+    # Run loop
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        loop = asyncio.get_running_loop()
+        self.origin = time.monotonic() - self.tick * self.resolution
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self.__run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def __run(self):
+        while True:
+
+            # process every tick that is due, including ticks missed while the loop was busy
+            due = int((time.monotonic() - self.origin) / self.resolution)
+            while self.tick < due:
+                self.__advance()
+
+            # sleep until the next bucket with subscribers (or until woken by a new timer)
+            self.sleep_until = self.__next_pending()
+            self.wakeup.clear()
+            if self.sleep_until is None:
+                await self.wakeup.wait()
+            else:
+                delay = self.origin + self.sleep_until * self.resolution - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            self.sleep_until = None
+
+    # ===========================================
+    # Wheel internals
+    def __add(self, timer: Timer) -> Timer:
+        self.count += 1
+        self.__insert(timer)
+
+        # start lazily once there is something to run
+        if self.task is None:
+            try:
+                self.start()
+            except RuntimeError:
+                pass # no running loop yet, start() is called on bot startup
+        # wake the run loop if it sleeps past this timer, or idles with no timers at all
+        elif not self.task.done() and (self.sleep_until is None or timer.expires < self.sleep_until):
+            self.wakeup.set()
+
+        return timer
+
+    def __insert(self, timer: Timer):
+        delta = timer.expires - self.tick
+        span = WHEEL_SLOTS
+        for level in range(WHEEL_LEVELS):
+            if delta < span:
+                slot = (timer.expires // (span // WHEEL_SLOTS)) % WHEEL_SLOTS
+                self.wheels[level][slot].append(timer)
+                return
+            span *= WHEEL_SLOTS
+        self.overflow.append(timer)
+
+    def __cascade(self, level):
+        span = WHEEL_SLOTS ** level
+        slot = (self.tick // span) % WHEEL_SLOTS
+        bucket = self.wheels[level][slot]
+        if bucket:
+            self.wheels[level][slot] = []
+            for timer in bucket:
+                if not timer.cancelled:
+                    self.__insert(timer)
+
+    def __advance(self):
+        self.tick += 1
+
+        # move timers down from the upper levels as the lower wheels wrap
+        if self.tick % WHEEL_SLOTS == 0:
+            if self.tick % (WHEEL_SLOTS ** WHEEL_LEVELS) == 0 and self.overflow:
+                overflow, self.overflow = self.overflow, []
+                for timer in overflow:
+                    if not timer.cancelled:
+                        self.__insert(timer)
+            for level in range(WHEEL_LEVELS - 1, 0, -1):
+                if self.tick % (WHEEL_SLOTS ** level) == 0:
+                    self.__cascade(level)
+
+        slot = self.tick % WHEEL_SLOTS
+        bucket = self.wheels[0][slot]
+        if not bucket:
+            return
+        self.wheels[0][slot] = []
+
+        for timer in bucket:
+            if timer.cancelled:
+                continue
+
+            # periodic timers are re-armed before the call so a callback can cancel itself
+            if timer.interval:
+                timer.expires = self.tick + timer.interval
+                self.__insert(timer)
+            else:
+                timer.cancelled = True
+                self.count -= 1
+
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result):
+                    asyncio.get_running_loop().create_task(result)
+            except:
+                traceback.print_exc()
+
+    # Next tick with a non-empty bucket, or the next cascade if the lowest wheel is empty
+    def __next_pending(self):
+        if self.count <= 0:
+            return None
+        for offset in range(1, WHEEL_SLOTS + 1):
+            tick = self.tick + offset
+            if any(not timer.cancelled for timer in self.wheels[0][tick % WHEEL_SLOTS]):
+                return tick
+            if tick % WHEEL_SLOTS == 0:
+                return tick
+        return self.tick + WHEEL_SLOTS
@@ -1,25 +1,122 @@
 
-import json
+import asyncio, copy, json, os, threading, mmap, struct, sys, zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .store_sqlite import normKey
 
 PERSIST_MANIFEST = 'manifest.json'
 PERSIST_FILE_EXT = '.dat'
+PERSIST_BIN_EXT = '.bin'
+PERSIST_LOG_EXT = '.log'
+PERSIST_TMP_EXT = '.tmp'
 storageDir = './'
 
+# Snapshot formats
+FORMAT_JSON = 'json'     # one JSON object per collection (.dat)
+FORMAT_BINARY = 'binary' # length-prefixed JSON records in optionally compressed blocks (.bin)
+snapshotFormat = FORMAT_JSON
+compressSnapshots = False
+
+# Binary snapshot layout: header, then length-prefixed records [u32 size][payload],
+# each payload a UTF-8 JSON object of up to BIN_BLOCK_ITEMS items, zlib-compressed if flagged.
+BIN_MAGIC = b'DLST'
+BIN_VERSION = 2
+BIN_FLAG_ZLIB = 1
+BIN_HEADER = struct.Struct('<4sBB')
+BIN_SIZE = struct.Struct('<I')
+BIN_BLOCK_ITEMS = 1024
+
+# Storage engines
+ENGINE_JSON = 'json' # whole collection rewritten by persistCollection
+ENGINE_WAL = 'wal'   # item changes appended to a log, compacted into the snapshot
+ENGINE_SQLITE = 'sqlite' # items kept on disk in SQLite, read and written per key
+engine = ENGINE_JSON
+
+# Pluggable backend, replaces the file engines when set (see store_sqlite.SqliteBackend)
+backend = None
+
+# Load collections on first access instead of in load()
+lazyLoad = True
+
+# WAL settings
+compactRatio = 2.0          # compact once the log is this many times the snapshot size
+compactMinBytes = 64 * 1024 # ...and at least this big
+syncWrites = False          # fsync every log append
+
 storage = {}
 meta = {
     'count': 0,
     'list': []
 }
 
+# WAL state per collection
+logs = {}           # name: open log file
+logSizes = {}       # name: bytes in the current log
+snapshotSizes = {}  # name: bytes in the last snapshot
+compacting = {}     # name: compaction future, compactions run on the storage executor
+logLock = threading.RLock() # log handles are written on the storage thread and rotated on either thread
+
+# Dirty tracking, used once the background flusher is running
+dirty = {}          # name: set of changed keys, None if the whole collection changed
+dirtyCount = 0      # changes since the last flush
+flushInterval = 5.0 # seconds between flushes
+flushThreshold = 1000 # changes that trigger an early flush
+flushTask = None
+flushEvent = None
+flushLock = None
+flushStopping = False
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+
 # Storge directory
 def setDir(dir):
     global storageDir
     storageDir = dir
     print(f'storage: using directory {storageDir}')
 
+# Snapshot format for the file engines
+def setFormat(name, compress=None):
+    global snapshotFormat, compressSnapshots
+    if name not in (FORMAT_JSON, FORMAT_BINARY):
+        raise ValueError(f'unknown storage format: {name}')
+    snapshotFormat = name
+    if compress is not None:
+        compressSnapshots = compress
+    print(f'storage: using {snapshotFormat} snapshots{" (compressed)" if compressSnapshots and snapshotFormat == FORMAT_BINARY else ""}')
+
+# Storage engine, set before load
+def setEngine(name, ratio=None, minBytes=None, sync=None, lazy=None, cacheSize=None):
+    global engine, compactRatio, compactMinBytes, syncWrites, lazyLoad
+    if name not in (ENGINE_JSON, ENGINE_WAL, ENGINE_SQLITE):
+        raise ValueError(f'unknown storage engine: {name}')
+    engine = name
+    if ratio is not None:
+        compactRatio = ratio
+    if minBytes is not None:
+        compactMinBytes = minBytes
+    if sync is not None:
+        syncWrites = sync
+    if lazy is not None:
+        lazyLoad = lazy
+
+    if engine == ENGINE_SQLITE:
+        from .store_sqlite import SqliteBackend
+        setBackend(SqliteBackend(storageDir, cacheSize=cacheSize))
+    else:
+        setBackend(None)
+    print(f'storage: using engine {engine}')
+
+# Use a custom backend object implementing the collection functions below
+def setBackend(obj):
+    global backend
+    backend = obj
+
 # AFTER load - add collection to storage, store in file, update meta
 def useCollection(name):
-    if len(storage) > 0 and name in storage:
+    if backend is not None:
+        return backend.useCollection(name)
+
+    if name in meta['list']:
         return
     else:
         storage[name] = {}
@@ -30,46 +127,99 @@ def useCollection(name):
         writeManifest()
 
 
-# Access a collection for reading and writing
+# Access a collection for reading, writes through the returned dict skip the log and dirty
+# tracking and are only saved with the next full snapshot, use setCollectionItem instead
 def getCollection(name):
+    if backend is not None:
+        return backend.getCollection(name)
+    ensureLoaded(name)
     return storage[name]
 
+# Read one collection item
+def getCollectionItem(name, key, default=None):
+    if backend is not None:
+        return backend.getCollectionItem(name, key, default)
+    ensureLoaded(name)
+    return storage[name].get(key, default) if name in storage else default
+
 # Does this collection exist
 def hasCollection(name):
-    return name in storage
+    if backend is not None:
+        return backend.hasCollection(name)
+    return name in storage or name in meta['list']
 
 # Clear a collection
 def clearCollection(name):
+    if backend is not None:
+        return backend.clearCollection(name)
+    ensureLoaded(name)
     if name in storage:
         storage[name] = {}
+        recordChange(name, None, {'c': {}})
 
 # Set entire collection
 def setCollection(name, data):
+    if backend is not None:
+        return backend.setCollection(name, data)
+    ensureLoaded(name)
     if name in storage and storage[name] != None:
         storage[name] = data
+        recordChange(name, None, {'c': data})
 
-# Set a collection item (can just use getCollection reference)
+# Set a collection item, logged or marked dirty for the flusher
 def setCollectionItem(name, key, item):
+    if backend is not None:
+        return backend.setCollectionItem(name, key, item)
+    ensureLoaded(name)
     if name in storage and storage[name] != None:
         storage[name][key] = item
+        recordChange(name, key, {'s': {key: item}})
 
 # Remove a collection item
 def removeCollectionItem(name, key):
+    if backend is not None:
+        return backend.removeCollectionItem(name, key)
+    ensureLoaded(name)
     if name in storage and storage[name] != None:
         if key in storage[name]:
             del storage[name][key]
+            recordChange(name, key, {'r': {key: None}})
+
+# Load a collection listed in the manifest on first access
+def ensureLoaded(name):
+    if name in storage or name not in meta['list']:
+        return
+
+    try:
+        collection = loadCollection(name)
+    except:
+        print(f'storage: error loading collection [{name}]')
+        raise
+
+    storage[name] = collection if collection is not None else {}
+    print(f'storage: loaded collection [{name}] ({len(storage[name])} lines)')
 
 # Write the manifest file
 def writeManifest():
-    manifest = open(storageDir + PERSIST_MANIFEST, 'w')
-    manifest.write(json.dumps(meta))
-    manifest.close()
+    writeAtomic(storageDir + PERSIST_MANIFEST, json.dumps(meta))
+
+# Write a file through a temp file and rename, so a crash leaves either the old or new file
+def writeAtomic(path, content):
+    tmp = path + PERSIST_TMP_EXT
+    with open(tmp, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 # Load all state data
 def load():
     global storage
     global meta
 
+    if backend is not None:
+        return backend.load()
+
     n = 0 # loaded collections count
     newList = [] # loaded collections keys
     rewrite = False # should meta be rewritten
@@ -90,25 +240,25 @@ def load():
         count = meta['count']
         list = meta['list']
 
+        # collections are read on first access
+        if lazyLoad:
+            print(f'storage: found {count} collections, loading on first access')
+            return
+
         # If metadata was successfully loaded it is rewritable
         rewrite = True
 
         for item in list:
             try:
-                file = open(storageDir + item + PERSIST_FILE_EXT, 'r')
-                str = ''.join(file.readlines())
-                if len(str) > 0:
-                    collection = json.loads(str)
-                    if collection != None:
-                        storage[item] = collection
-                        newList.append(item)
-                        print(f'storage: loaded collection [{item}] ({len(collection)} lines)')
-                        n += 1
+                collection = loadCollection(item)
+                if collection != None:
+                    storage[item] = collection
+                    newList.append(item)
+                    print(f'storage: loaded collection [{item}] ({len(collection)} lines)')
+                    n += 1
             except:
                 print(f'storage: error loading collection [{item}]')
-            finally:
-                file.close()
-        
+
         print(f'storage: finished loading {n} collections (expected {count})')
 
     except:
@@ -122,23 +272,397 @@ def load():
             writeManifest()
             print('storage: rewriting metadata')
 
+# Read one collection's snapshot, and replay its logs in WAL mode
+def loadCollection(name):
+    collection = readSnapshot(name)
+
+    if engine == ENGINE_WAL:
+
+        # a log left behind by an interrupted compaction comes before the current log
+        for log in (oldLogPath(name), storageDir + name + PERSIST_LOG_EXT):
+            if os.path.isfile(log):
+                if collection is None:
+                    collection = {}
+                collection = replayLog(log, collection)
+        if collection is not None:
+            openLog(name)
+
+    return collection
+
+# ===========================================
+# Snapshot files
+def snapshotPath(name, format=None):
+    format = format or snapshotFormat
+    return storageDir + name + (PERSIST_BIN_EXT if format == FORMAT_BINARY else PERSIST_FILE_EXT)
+
+# Read a collection snapshot, in the configured format or else the other one
+def readSnapshot(name):
+    other = FORMAT_JSON if snapshotFormat == FORMAT_BINARY else FORMAT_BINARY
+    for format in (snapshotFormat, other):
+        path = snapshotPath(name, format)
+        if os.path.isfile(path):
+            snapshotSizes[name] = os.path.getsize(path)
+            if format == FORMAT_BINARY:
+                return readBinary(path)
+            with open(path, 'r') as file:
+                content = file.read()
+            return json.loads(content) if len(content) > 0 else None
+    return None
+
+# Write a collection snapshot atomically, returns its size in bytes
+def writeSnapshotFile(name, data):
+    path = snapshotPath(name)
+    if snapshotFormat == FORMAT_BINARY:
+        writeBinary(path, data, compressSnapshots)
+    else:
+        writeAtomic(path, json.dumps(data))
+
+    # a snapshot left in the other format is now stale
+    other = snapshotPath(name, FORMAT_JSON if snapshotFormat == FORMAT_BINARY else FORMAT_BINARY)
+    if os.path.isfile(other):
+        os.remove(other)
+
+    size = os.path.getsize(path)
+    snapshotSizes[name] = size
+    return size
+
+# Stream records out, so writing never holds more than one encoded record
+def writeBinary(path, data, compress=False):
+    tmp = path + PERSIST_TMP_EXT
+    with open(tmp, 'wb') as f:
+        f.write(BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, BIN_FLAG_ZLIB if compress else 0))
+
+        def writeRecord(chunk):
+            record = json.dumps(chunk, separators=(',', ':')).encode()
+            if compress:
+                record = zlib.compress(record)
+            f.write(BIN_SIZE.pack(len(record)))
+            f.write(record)
+
+        chunk = {}
+        for key, value in data.items():
+            chunk[normKey(key)] = value
+            if len(chunk) >= BIN_BLOCK_ITEMS:
+                writeRecord(chunk)
+                chunk = {}
+        if chunk:
+            writeRecord(chunk)
+
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# Read records straight off a memory map, one record in memory at a time
+def readBinary(path):
+    collection = {}
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, flags = BIN_HEADER.unpack_from(mm, 0)
+            if magic != BIN_MAGIC or version != BIN_VERSION:
+                raise ValueError(f'not a storage snapshot (version {version}): {path}')
+
+            pos = BIN_HEADER.size
+            end = len(mm)
+            while pos < end:
+                (size,) = BIN_SIZE.unpack_from(mm, pos)
+                pos += BIN_SIZE.size
+                record = mm[pos:pos + size]
+                pos += size
+                if flags & BIN_FLAG_ZLIB:
+                    record = zlib.decompress(record)
+                collection.update(json.loads(record))
+    return collection
+
+# Apply log records to a collection
+def replayLog(path, collection):
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # torn write at the end of the log
+                print(f'storage: skipping bad log record in {path}')
+                continue
+
+            if 's' in record:
+                collection.update(record['s'])
+            elif 'r' in record:
+                for key in record['r']:
+                    collection.pop(key, None)
+            elif 'c' in record:
+                collection = dict(record['c'])
+    return collection
+
+# ===========================================
+# Write-ahead log
+def openLog(name):
+    with logLock:
+        openLogLocked(name)
+
+def openLogLocked(name):
+    if name not in logs:
+        path = storageDir + name + PERSIST_LOG_EXT
+        logs[name] = open(path, 'a')
+        logSizes[name] = os.path.getsize(path)
+
+        # terminate a torn last record so new records start on their own line
+        if logSizes[name] > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    logs[name].write('\n')
+                    logSizes[name] += 1
+
+def appendLog(name, record):
+    if engine != ENGINE_WAL:
+        return
+    if writeRecords(name, [record]) > max(compactMinBytes, compactRatio * snapshotSizes.get(name, 0)):
+        compactCollection(name)
+
+# Append a batch of records to a collection's log, returns the log size
+def writeRecords(name, records):
+    content = ''.join(json.dumps(record) + '\n' for record in records)
+    with logLock:
+        openLogLocked(name)
+        log = logs[name]
+        log.write(content)
+        log.flush()
+        if syncWrites:
+            os.fsync(log.fileno())
+        logSizes[name] += len(content)
+        return logSizes[name]
+
+# Fold the log into a fresh snapshot on the storage thread
+def compactCollection(name, wait=False):
+    if name in compacting and not compacting[name].done():
+        return
+
+    rotateLog(name)
+
+    # the loop keeps changing nested items while the storage thread serializes
+    data = copy.deepcopy(storage[name])
+
+    compacting[name] = executor.submit(writeSnapshot, name, data)
+    if wait:
+        compacting[name].result()
+
+# Start a new log generation, the old one stays until the snapshot is safely written
+def rotateLog(name):
+    with logLock:
+        if name in logs:
+            logs.pop(name).close()
+            path, old = storageDir + name + PERSIST_LOG_EXT, oldLogPath(name)
+
+            # an old generation left by a failed compaction is in no snapshot yet, keep it ahead of this one
+            if os.path.isfile(old):
+                with open(path, 'rb') as src, open(old, 'ab') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(path)
+            else:
+                os.replace(path, old)
+        openLogLocked(name)
+
+def oldLogPath(name):
+    return storageDir + name + PERSIST_LOG_EXT + '.1'
+
+def writeSnapshot(name, data):
+    old = oldLogPath(name)
+    try:
+        writeSnapshotFile(name, data)
+        if os.path.isfile(old):
+            os.remove(old)
+        print(f'storage: compacted collection [{name}] ({len(data)} lines)')
+    except:
+        print(f'storage: error compacting collection [{name}]')
+
 # Store collection data
 def persistCollection(name):
+    if backend is not None:
+        return backend.persistCollection(name)
+
     if storage != None and len(storage) > 0 and name in storage:
-        str = json.dumps(storage[name])
+
+        # in WAL mode the log is already durable, persisting means taking a snapshot
+        if engine == ENGINE_WAL:
+            if name in compacting:
+                compacting[name].result()
+            compactCollection(name, wait=True)
+            return
 
         try:
-            f = open(storageDir + name + PERSIST_FILE_EXT, "w")
-            f.write(str)
+            writeSnapshotFile(name, storage[name])
             print(f'storage: wrote collection [{name}] ({len(storage[name])} lines)')
         except:
             print(f'storage: error writing collection [{name}]')
-        finally:
-            f.close()
 
     else:
         print(f'storage: no collection data for [{name}]')
 
 
+# Store every collection (blocking, use flush() from async code)
 def persistAll():
-    pass
+    global dirty, dirtyCount
+    if backend is not None:
+        return backend.persistAll()
+
+    for name in list(storage):
+        persistCollection(name)
+    dirty = {}
+    dirtyCount = 0
+
+# ===========================================
+# Dirty tracking and background flush
+# Log the change now, or mark it dirty for the flusher
+def recordChange(name, key, record):
+    global dirtyCount
+    if flushTask is None:
+        appendLog(name, record)
+        return
+
+    markDirty(name, None if key is None else {key})
+    dirtyCount += 1
+    if dirtyCount >= flushThreshold:
+        flushEvent.set()
+
+# Mark keys of a collection dirty, None marks the whole collection
+def markDirty(name, keys):
+    if keys is None:
+        dirty[name] = None
+    elif name not in dirty:
+        dirty[name] = set(keys)
+    elif dirty[name] is not None:
+        dirty[name] |= keys
+
+# Start flushing dirty collections every interval seconds, or after threshold changes
+def startFlusher(interval=None, threshold=None):
+    global flushTask, flushEvent, flushInterval, flushThreshold
+    if flushTask is not None:
+        return
+    if interval is not None:
+        flushInterval = interval
+    if threshold is not None:
+        flushThreshold = threshold
+
+    flushEvent = asyncio.Event()
+    flushTask = asyncio.get_running_loop().create_task(flushLoop())
+    print(f'storage: flushing every {flushInterval}s or {flushThreshold} changes')
+
+# Stop the flusher and write out everything still dirty
+async def stopFlusher():
+    global flushTask, flushStopping
+    if flushTask is not None:
+
+        # cancelling could interrupt a flush that already took the dirty set, let it finish instead
+        flushStopping = True
+        flushEvent.set()
+        await flushTask
+        flushTask = None
+        flushStopping = False
+    try:
+        await flush()
+    except Exception as e:
+        print(f'storage: error flushing ({e}), {len(dirty)} collections not written')
+
+async def flushLoop():
+    while True:
+        try:
+            await asyncio.wait_for(flushEvent.wait(), flushInterval)
+        except asyncio.TimeoutError:
+            pass
+        flushEvent.clear()
+        if flushStopping:
+            return
+
+        try:
+            await flush()
+        except Exception as e:
+            print(f'storage: error flushing ({e})')
+
+# Write dirty collections, serializing and writing on the storage thread
+async def flush():
+    global dirty, dirtyCount, flushLock
+    if flushLock is None:
+        flushLock = asyncio.Lock()
+
+    if backend is not None:
+        return await backend.flush()
+
+    loop = asyncio.get_running_loop()
+    async with flushLock:
+        pending, dirty = dirty, {}
+        dirtyCount = 0
+
+        names = list(pending)
+        for i, name in enumerate(names):
+            if name not in storage or storage[name] is None:
+                continue
+            collection = storage[name]
+            keys = pending[name]
+
+            # only deep copies are handed to the storage thread, items can change while it serializes
+            try:
+                if engine == ENGINE_WAL:
+                    if keys is None:
+                        records = [{'c': copy.deepcopy(collection)}]
+                    else:
+                        sets = {key: copy.deepcopy(collection[key]) for key in keys if key in collection}
+                        removes = {key: None for key in keys if key not in collection}
+                        records = ([{'s': sets}] if sets else []) + ([{'r': removes}] if removes else [])
+
+                    size = await loop.run_in_executor(executor, writeRecords, name, records)
+                    if size > max(compactMinBytes, compactRatio * snapshotSizes.get(name, 0)):
+                        await loop.run_in_executor(executor, compactNow, name, copy.deepcopy(collection))
+                else:
+                    await loop.run_in_executor(executor, writeCollection, name, copy.deepcopy(collection))
+            except:
+                # keep everything from here on dirty for the next flush, writing a record twice is harmless
+                for unwritten in names[i:]:
+                    markDirty(unwritten, pending[unwritten])
+                    dirtyCount += 1
+                raise
+
+def compactNow(name, data):
+    rotateLog(name)
+    writeSnapshot(name, data)
+
+# Errors are left to the caller, flush keeps the collection dirty
+def writeCollection(name, data):
+    writeSnapshotFile(name, data)
+
+# ===========================================
+# Migration
+# Convert every collection in a storage directory to the binary format, folding in any logs
+def migrate(dir, compress=False):
+    setDir(dir)
+    setEngine(ENGINE_WAL, lazy=False)
+    load()
+
+    setFormat(FORMAT_BINARY, compress=compress)
+    for name in list(storage):
+        old = storageDir + name + PERSIST_FILE_EXT
+        before = os.path.getsize(old) if os.path.isfile(old) else 0
+        if os.path.isfile(old):
+            os.replace(old, old + '.bak')
+
+        size = writeSnapshotFile(name, storage[name])
+
+        # logs are folded into the snapshot
+        if name in logs:
+            logs.pop(name).close()
+        for log in (storageDir + name + PERSIST_LOG_EXT, oldLogPath(name)):
+            if os.path.isfile(log):
+                os.remove(log)
+
+        print(f'storage: migrated collection [{name}] ({len(storage[name])} lines, {before} -> {size} bytes)')
+
+    writeManifest()
+
+
+if __name__ == '__main__':
+    # python -m bot.tools.store migrate <dir> [--compress]
+    if len(sys.argv) >= 3 and sys.argv[1] == 'migrate':
+        migrate(os.path.join(sys.argv[2], ''), compress='--compress' in sys.argv)
+    else:
+        print('usage: python -m bot.tools.store migrate <dir> [--compress]')
@@ -0,0 +1,175 @@
+
+import json, sqlite3
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+PERSIST_DATABASE = 'storage.db'
+
+# Keys are stored the way JSON stores object keys, so all engines agree after a reload
+def normKey(key):
+    return key if isinstance(key, str) else json.dumps(key)
+
+
+class CollectionView(MutableMapping):
+    '''Dict-like view of one collection, reading and writing single items in SQLite'''
+
+    def __init__(self, db, name, cacheSize=0) -> None:
+        self.db = db
+        self.name = name
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict() # key: value, least recently used first
+
+    def __getitem__(self, key):
+        key = normKey(key)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        row = self.db.execute('SELECT value FROM items WHERE collection = ? AND key = ?', (self.name, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        value = json.loads(row[0])
+        self.__cache(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        key = normKey(key)
+        self.db.execute('INSERT OR REPLACE INTO items (collection, key, value) VALUES (?, ?, ?)', (self.name, key, json.dumps(value)))
+        self.__cache(key, value)
+
+    def __delitem__(self, key):
+        key = normKey(key)
+        if self.db.execute('DELETE FROM items WHERE collection = ? AND key = ?', (self.name, key)).rowcount == 0:
+            raise KeyError(key)
+        self.cache.pop(key, None)
+
+    def __contains__(self, key):
+        key = normKey(key)
+        if key in self.cache:
+            return True
+        return self.db.execute('SELECT 1 FROM items WHERE collection = ? AND key = ?', (self.name, key)).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.db.execute('SELECT key FROM items WHERE collection = ?', (self.name,)):
+            yield row[0]
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM items WHERE collection = ?', (self.name,)).fetchone()[0]
+
+    # Single query instead of one lookup per key
+    def items(self):
+        for key, value in self.db.execute('SELECT key, value FROM items WHERE collection = ?', (self.name,)):
+            yield key, json.loads(value)
+
+    def clear(self):
+        self.db.execute('DELETE FROM items WHERE collection = ?', (self.name,))
+        self.cache.clear()
+
+    def update(self, data=(), **kwargs):
+        data = dict(data, **kwargs)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO items (collection, key, value) VALUES (?, ?, ?)',
+            ((self.name, normKey(key), json.dumps(value)) for key, value in data.items())
+        )
+        for key, value in data.items():
+            self.__cache(normKey(key), value)
+
+    def __cache(self, key, value):
+        if self.cacheSize <= 0:
+            return
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+
+
+class SqliteBackend:
+    '''Store backend keeping every collection in one SQLite database'''
+
+    def __init__(self, dir, cacheSize=None) -> None:
+        self.path = dir + PERSIST_DATABASE
+        self.cacheSize = cacheSize or 0
+        self.db = None
+        self.collections = set()
+        self.views = {} # name: CollectionView
+
+    def load(self):
+        # autocommit, the WAL journal keeps single-row writes cheap
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS collections (name TEXT PRIMARY KEY)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items (collection TEXT, key TEXT, value TEXT, PRIMARY KEY (collection, key)) WITHOUT ROWID')
+
+        self.collections = {row[0] for row in self.db.execute('SELECT name FROM collections')}
+        print(f'storage: opened {self.path} ({len(self.collections)} collections)')
+
+    # Other shard processes may have added the collection since load, they share the database
+    def useCollection(self, name):
+        if name not in self.collections:
+            if self.db.execute('INSERT OR IGNORE INTO collections (name) VALUES (?)', (name,)).rowcount:
+                print(f'storage: added collection [{name}]')
+            self.collections.add(name)
+
+    def hasCollection(self, name):
+        if name in self.collections:
+            return True
+        if self.db.execute('SELECT 1 FROM collections WHERE name = ?', (name,)).fetchone() is None:
+            return False
+        self.collections.add(name)
+        return True
+
+    def getCollection(self, name):
+        if name not in self.views:
+            if not self.hasCollection(name):
+                raise KeyError(name)
+            self.views[name] = CollectionView(self.db, name, cacheSize=self.cacheSize)
+        return self.views[name]
+
+    def getCollectionItem(self, name, key, default=None):
+        if not self.hasCollection(name):
+            return default
+        return self.getCollection(name).get(key, default)
+
+    def clearCollection(self, name):
+        if self.hasCollection(name):
+            self.getCollection(name).clear()
+
+    def setCollection(self, name, data):
+        if self.hasCollection(name):
+            view = self.getCollection(name)
+            self.db.execute('BEGIN')
+            try:
+                view.clear()
+                view.update(data)
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                view.cache.clear()
+                raise
+
+    def setCollectionItem(self, name, key, item):
+        if self.hasCollection(name):
+            self.getCollection(name)[key] = item
+
+    def removeCollectionItem(self, name, key):
+        if self.hasCollection(name):
+            self.getCollection(name).pop(key, None)
+
+    # Every write is already on disk
+    def persistCollection(self, name):
+        pass
+
+    def persistAll(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            self.collections = set()
+            self.views = {}
@@ -1,7 +1,7 @@
 
 # Utility functions
 
-import os, logging
+import os, sys, logging, hashlib
 
 class Singleton(type):
     '''Use as metaclass to implement singleton pattern'''
@@ -26,3 +26,60 @@ def path_resolve(filename, force_exists=True):
         return fullpath
     else:
         raise IOError('Could not find: {}'.format(fullpath))
+
+
+def file_signature(path, previous=None):
+    '''(mtime, size, digest) of a file, or None if it is missing.
+    The content is only hashed again when mtime or size moved since previous'''
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if previous is not None and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+        return previous
+
+    with open(path, 'rb') as file:
+        digest = hashlib.blake2b(file.read(), digest_size=16).digest()
+    return (stat.st_mtime_ns, stat.st_size, digest)
+
+
+def signature_changed(previous, current):
+    '''True if the content behind two file signatures differs'''
+
+    if previous is None or current is None:
+        return previous is not current
+    return previous[2] != current[2]
+
+
+
+# Objects from these packages are counted but not followed, they reference shared client state
+SIZEOF_OPAQUE = {'discord', 'asyncio', 'logging', 'concurrent', 'multiprocessing', 'weakref', '_weakref'}
+
+def deep_sizeof(obj, skip=()):
+    '''Approximate memory held by obj and everything it references, objects in skip are not followed'''
+
+    seen = {id(item) for item in skip}
+    pending = [obj]
+    total = 0
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or isinstance(item, type):
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+
+        if type(item).__module__.split('.')[0] in SIZEOF_OPAQUE:
+            continue
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            pending.extend(item)
+        if hasattr(item, '__dict__'):
+            pending.append(item.__dict__)
+        for slot in getattr(type(item), '__slots__', ()):
+            if hasattr(item, slot):
+                pending.append(getattr(item, slot))
+    return total
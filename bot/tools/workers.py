@@ -0,0 +1,48 @@
+
+import os, multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from bot.tools.util import Singleton
+
+
+class WorkerPool(metaclass=Singleton):
+    '''Worker processes hosting games that run outside the bot's event loop.
+    Each worker is a single-process executor, so a game always runs in the same process'''
+
+    def __init__(self, size=0) -> None:
+        self.size = size or os.cpu_count() or 1
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = {} # ProcessPoolExecutor: games assigned
+
+    # Worker with the fewest games, started on demand
+    def acquire(self) -> ProcessPoolExecutor:
+        if len(self.workers) < self.size and all(self.workers.values()):
+            worker = ProcessPoolExecutor(max_workers=1, mp_context=self.context)
+            self.workers[worker] = 0
+        else:
+            worker = min(self.workers, key=self.workers.get)
+
+        self.workers[worker] += 1
+        return worker
+
+    def release(self, worker: ProcessPoolExecutor):
+        if worker in self.workers:
+            self.workers[worker] -= 1
+
+    # A worker that died takes its games with it, don't hand it out again
+    def discard(self, worker: ProcessPoolExecutor):
+        if self.workers.pop(worker, None) is not None:
+            worker.shutdown(wait=False)
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown(wait=False, cancel_futures=True)
+        self.workers.clear()
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'size': self.size,
+            'games': sum(self.workers.values())
+        }
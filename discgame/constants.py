@@ -1,7 +1,87 @@
-
 class GameDefaults:
     
     screen_size = 30
 
     idle_timeout = 60
 
+    tick_policy = 'coalesce'
+
+    tick_queue_size = 5
+
+    max_fps = 1.0
+
+    # Discord allows roughly 5 message writes per 5 seconds per channel
+    edit_bucket_size = 5
+
+    edit_bucket_period = 5.0
+
+    # re-post the game message when it is no longer the channel's last message
+    repost_policy = 'always'
+
+    repost_interval = 10.0
+
+    execution = 'inline'
+
+    # player messages waiting for the game, and how many of them one player may hold
+    input_queue_size = 32
+
+    input_user_limit = 4
+
+    input_policy = 'drop_oldest'
+
+    # seconds a player has to take their turn in turn-based games
+    turn_timeout = 60
+
+
+# How a game handles a tick that arrives while the previous one is still running
+class TickPolicy:
+
+    SKIP = 'skip'           # drop the new tick
+
+    COALESCE = 'coalesce'   # run once more after the current tick, extra ticks are dropped
+
+    QUEUE = 'queue'         # queue ticks up to GameDefaults.tick_queue_size, drop the rest
+
+    ALL = {SKIP, COALESCE, QUEUE}
+
+
+# What the monitor does when other messages push the game message up the channel
+class RepostPolicy:
+
+    ALWAYS = 'always'       # move the game message back to the bottom (at most once per repost_interval)
+
+    NEVER = 'never'         # keep editing the game message in place
+
+    ALL = {ALWAYS, NEVER}
+
+
+# Where a game's logic runs
+class ExecutionMode:
+
+    INLINE = 'inline'       # on the bot's event loop
+
+    PROCESS = 'process'     # in a worker process, render commands are sent back to the monitor
+
+    ALL = {INLINE, PROCESS}
+
+
+
+# What a game's input queue does with a message that doesn't fit
+class InputPolicy:
+
+    DROP_OLDEST = 'drop_oldest'     # make room by dropping the oldest queued message
+
+    DROP_FLOOD = 'drop_flood'       # drop the new message if its author already holds input_user_limit messages
+
+    ALL = {DROP_OLDEST, DROP_FLOOD}
+
+
+
+# What a turn-based game does when a player runs out of time
+class TurnTimeout:
+
+    SKIP = 'skip'           # move on to the next player
+
+    FORFEIT = 'forfeit'     # remove the player from the turn order
+
+    ALL = {SKIP, FORFEIT}
@@ -1,27 +1,55 @@
 
 # Game objects
 
+import asyncio, time, traceback
+
 from datetime import datetime
 
-from .constants import GameDefaults
+from .constants import GameDefaults, TickPolicy
 from .monitor import DiscGameMonitor
 
 # Base game
 class DiscGame:
+
+    # overridable per game class, or per library entry in games.json
+    tick_policy = GameDefaults.tick_policy
+    tick_queue_size = GameDefaults.tick_queue_size
+
+    # take player messages as one batch per second tick instead of one at a time
+    input_batch = False
+
+    # subscribe to the launcher's second tick
+    second_ticks = True
+
     def __init__(self, monitor) -> None:
         self.monitor = monitor
 
         self.started_at = datetime.now()        # datetime that this game was started
         self.ended_at = None                      # datetime that this game was ended
-        self.last_message_time = None             # last time a message was received
-        self.idle_time_seconds = datetime.now() # total idle time in seconds
-        self.total_time_seconds = 0            # total runtime in seconds
-        
-        self.idle_timeout = GameDefaults.idle_timeout       
+        self.started_time = time.monotonic()      # monotonic clock at start, for durations
+        self.ended_time = None                    # monotonic clock at end
+        self.last_message_time = None             # monotonic clock at the last message received
+
+        self.idle_timeout = GameDefaults.idle_timeout       # seconds without messages before the launcher ends the game, 0 never
+
+        self.dropped_ticks = 0                    # ticks dropped by the tick policy
+        self.input = None                         # InputQueue feeding this game, set by the launcher
+        self.__ticks = {}                         # tick name: [in-flight task, pending ticks]
 
     def __str__(self) -> str:
         return 
 
+    # Seconds since the last message (or the start), computed when asked instead of every tick
+    @property
+    def idle_time_seconds(self):
+        since = self.last_message_time if self.last_message_time is not None else self.started_time
+        return (self.ended_time or time.monotonic()) - since
+
+    # Seconds the game has been running
+    @property
+    def total_time_seconds(self):
+        return (self.ended_time or time.monotonic()) - self.started_time
+
 
     # ========================================
     # Interface calls
@@ -37,9 +65,14 @@ class DiscGame:
     async def leave(self):
         pass
 
-    async def message(self):
+    async def message(self, user_id, content):
         pass
 
+    # Batched input, one call per second tick when input_batch is set
+    async def messages(self, batch):
+        for user_id, content in batch:
+            await self.message(user_id, content)
+
     async def every_second(self):
         pass
 
@@ -51,11 +84,14 @@ class DiscGame:
     # Interal calls
     async def _start_interal(self):
         self.started_at = datetime.now()
+        self.started_time = time.monotonic()
 
         await self.start()
 
     async def _end_internal(self):
         self.ended_at = datetime.now()
+        self.ended_time = time.monotonic()
+        self.__cancel_ticks()
 
         await self.end()
 
@@ -63,19 +99,21 @@ class DiscGame:
         
         await self.join()
 
-    async def _message_interal(self):
-        self.last_message_time = datetime.now()
+    async def _message_interal(self, user_id, content):
+        self.last_message_time = time.monotonic()
+
+        await self.message(user_id, content)
+
+    async def _messages_internal(self, batch):
+        self.last_message_time = time.monotonic()
 
-        await self.message()
+        await self.messages(batch)
 
     async def _every_second_interal(self):
-        
-        if self.last_message_time is None:
-            self.idle_time_seconds = (datetime.now() - self.started_at).total_seconds()
-        else:
-            self.idle_time_seconds = (datetime.now() - self.last_message_time).total_seconds()
-            
-        self.total_time_seconds = (datetime.now() - self.started_at).total_seconds()
+
+        # batched games get the messages that arrived since the last tick first
+        if self.input_batch and self.input is not None and len(self.input) > 0:
+            await self._messages_internal(self.input.drain())
 
         await self.every_second()
     
@@ -85,3 +123,69 @@ class DiscGame:
 
         await self.every_minute()
 
+
+    # ========================================
+    # Tick dispatch
+    # Entry points for the launcher's 'second' and 'minute' events
+    def _tick_second(self):
+        self.__dispatch('second', self._every_second_interal)
+
+    def _tick_minute(self):
+        self.__dispatch('minute', self._every_minute_interal)
+
+    # Ticks currently running or waiting to run
+    @property
+    def pending_ticks(self):
+        return sum((task is not None) + pending for task, pending in self.__ticks.values())
+
+    # Run the tick, or hold/drop it per the tick policy if the previous one is still running
+    def __dispatch(self, name, tick):
+        if self.ended_at is not None:
+            return
+
+        state = self.__ticks.get(name)
+        if state is None:
+            state = self.__ticks[name] = [None, 0]
+
+        if state[0] is None:
+            state[0] = self.__run_tick(name, tick)
+            return
+
+        if self.tick_policy == TickPolicy.SKIP:
+            limit = 0
+        elif self.tick_policy == TickPolicy.QUEUE:
+            limit = self.tick_queue_size
+        else:
+            limit = 1
+
+        if state[1] < limit:
+            state[1] += 1
+        else:
+            self.dropped_ticks += 1
+
+    def __run_tick(self, name, tick):
+        task = asyncio.get_running_loop().create_task(tick())
+        task.add_done_callback(lambda t: self.__tick_done(name, tick, t))
+        return task
+
+    def __tick_done(self, name, tick, task):
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+        state = self.__ticks[name]
+        if state[0] is not task:
+            return
+
+        if state[1] > 0 and self.ended_at is None:
+            state[1] -= 1
+            state[0] = self.__run_tick(name, tick)
+        else:
+            state[0] = None
+
+    def __cancel_ticks(self):
+        for state in self.__ticks.values():
+            if state[0] is not None and state[0] is not asyncio.current_task():
+                state[0].cancel()
+            state[0] = None
+            state[1] = 0
@@ -1,7 +1,143 @@
+# Turn-based game
+
+import asyncio, traceback
 
+from .constants import GameDefaults, TurnTimeout
 from .game import DiscGame
+from .timers import TimerHeap
 
-# Turn-based game
+# Turn-based game, sleeps between turns and wakes when the turn changes
 class DiscTurnBasedGame(DiscGame):
-    def __init__(self) -> None:
-        super().__init__()
+
+    # turn-based games are woken by turns, not the second tick
+    second_ticks = False
+
+    # overridable per game class
+    turn_timeout = GameDefaults.turn_timeout
+    timeout_policy = TurnTimeout.SKIP
+
+    # messages from players whose turn it isn't are dropped unless this is set
+    off_turn_messages = False
+
+    def __init__(self, monitor) -> None:
+        super().__init__(monitor)
+
+        self.players = []           # turn order, user ids
+        self.turn_index = -1        # index into players of the current turn
+        self.turn = 0               # turns taken, identifies the current turn
+        self.waiting_on = None      # user id of the player the game is waiting on
+        self.deadline = None        # Deadline of the current turn
+        self.timers = TimerHeap.shared()
+        self.__tasks = set()
+
+
+    # ========================================
+    # Interface calls
+    # The turn changed to user_id
+    async def on_turn(self, user_id):
+        pass
+
+    # user_id ran out of time and was skipped
+    async def on_timeout(self, user_id):
+        pass
+
+    # user_id ran out of time and was removed from the turn order
+    async def on_forfeit(self, user_id):
+        pass
+
+
+    # ========================================
+    # Turn order
+    def add_player(self, user_id):
+        if user_id not in self.players:
+            self.players.append(user_id)
+
+    def remove_player(self, user_id):
+        if user_id not in self.players:
+            return
+        index = self.players.index(user_id)
+        self.players.remove(user_id)
+
+        # keep the turn with the player it belongs to
+        if index < self.turn_index:
+            self.turn_index -= 1
+        elif index == self.turn_index:
+            self.turn_index -= 1
+            self.__clear_turn()
+
+    @property
+    def current_player(self):
+        return self.waiting_on
+
+    # Hand the turn to the next player (or to user_id) and wait on them
+    async def next_turn(self, user_id=None):
+        self.__clear_turn()
+        if not self.players or self.ended_at is not None:
+            return
+
+        if user_id is not None and user_id in self.players:
+            self.turn_index = self.players.index(user_id)
+        else:
+            self.turn_index = (self.turn_index + 1) % len(self.players)
+
+        self.turn += 1
+        self.waiting_on = self.players[self.turn_index]
+        if self.turn_timeout:
+            self.deadline = self.timers.call_later(self.turn_timeout, self.__expired, self.turn)
+
+        await self.on_turn(self.waiting_on)
+
+
+    # ========================================
+    # Interal calls
+    async def _message_interal(self, user_id, content):
+        if user_id != self.waiting_on and not self.off_turn_messages:
+            return
+        await super()._message_interal(user_id, content)
+
+    async def _messages_internal(self, batch):
+        if not self.off_turn_messages:
+            batch = [(user_id, content) for user_id, content in batch if user_id == self.waiting_on]
+        if batch:
+            await super()._messages_internal(batch)
+
+    async def _end_internal(self):
+        self.__clear_turn()
+        for task in self.__tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+        await super()._end_internal()
+
+    # Deadline callback, runs on the loop outside any game coroutine
+    def __expired(self, turn):
+        task = asyncio.get_running_loop().create_task(self.__timeout(turn))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__task_done)
+
+    async def __timeout(self, turn):
+        # the player moved just as time ran out
+        if turn != self.turn or self.ended_at is not None:
+            return
+
+        user_id = self.waiting_on
+        self.deadline = None
+        if self.timeout_policy == TurnTimeout.FORFEIT:
+            self.remove_player(user_id)
+            await self.on_forfeit(user_id)
+        else:
+            await self.on_timeout(user_id)
+
+        await self.next_turn()
+
+    def __task_done(self, task):
+        self.__tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def __clear_turn(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        self.waiting_on = None
@@ -0,0 +1,74 @@
+# Player input queue for a DiscGame
+
+import asyncio
+
+from collections import deque
+
+from .constants import GameDefaults, InputPolicy
+
+class InputQueue:
+    '''Bounded, ordered queue of (user_id, content) messages waiting for a game'''
+
+    def __init__(self, size=None, policy=None, user_limit=None) -> None:
+        self.size = size if size is not None else GameDefaults.input_queue_size
+        self.policy = policy if policy is not None else GameDefaults.input_policy
+        self.user_limit = user_limit if user_limit is not None else GameDefaults.input_user_limit
+
+        self.items = deque()        # (user_id, content), oldest first
+        self.users = {}             # user_id: messages queued
+        self.ready = asyncio.Event()
+
+        # stats
+        self.received = 0
+        self.dropped = 0            # dropped to make room, or flood from one user
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    # Queue a message, returns False if it was dropped
+    def put(self, user_id, content) -> bool:
+        self.received += 1
+
+        if self.policy == InputPolicy.DROP_FLOOD and self.users.get(user_id, 0) >= self.user_limit:
+            self.dropped += 1
+            return False
+
+        if len(self.items) >= self.size:
+            self.__forget(self.items.popleft())
+            self.dropped += 1
+
+        self.items.append((user_id, content))
+        self.users[user_id] = self.users.get(user_id, 0) + 1
+        self.ready.set()
+        return True
+
+    # Next message, waits for one
+    async def get(self):
+        while not self.items:
+            self.ready.clear()
+            await self.ready.wait()
+
+        item = self.items.popleft()
+        self.__forget(item)
+        return item
+
+    # Everything queued, for games taking a batch per tick
+    def drain(self) -> list:
+        batch = list(self.items)
+        self.items.clear()
+        self.users.clear()
+        return batch
+
+    def stats(self):
+        return {
+            'depth': len(self.items),
+            'received': self.received,
+            'dropped': self.dropped
+        }
+
+    def __forget(self, item):
+        count = self.users[item[0]] - 1
+        if count:
+            self.users[item[0]] = count
+        else:
+            del self.users[item[0]]
@@ -1,18 +1,65 @@
 
 # Monitor for a DiscGame with functions to update it
 
-import logging, asyncio
+import logging, asyncio, time, traceback, weakref, hashlib
 
-from .constants import GameDefaults
+import numpy as np
+
+from collections import deque
+
+from .constants import GameDefaults, RepostPolicy
 from discord import NotFound
 
+# Screen buffers hold one little-endian UTF-32 codepoint per cell
+CODEPOINT = np.dtype('<u4')
+ENCODING = 'utf-32-le'
+
+class EditBucket:
+    '''Token bucket pacing message writes to a single channel'''
+
+    def __init__(self, size, period) -> None:
+        self.size = size
+        self.period = period
+        self.tokens = size
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.size, self.tokens + (now - self.updated) * self.size / self.period)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) * self.period / self.size)
+
+
 class DiscGameMonitor:
 
-    def __init__(self, bot, text_channel) -> None:
+    # edit buckets shared by every monitor writing to the same channel
+    buckets = weakref.WeakValueDictionary() # channel_id: EditBucket
+
+    # recent message ids for channels with a monitor, None until known (channel_id: deque)
+    recent_messages = {}
+
+    def __init__(self, bot, text_channel, max_fps=None, repost_policy=None, repost_interval=None, outbound=None, metrics=None) -> None:
         self.tc = text_channel
         self.bot = bot
         self.message = None
 
+        # shared outbound request scheduler, calls go straight to discord if not set
+        self.outbound = outbound
+        self.guild_id = text_channel.guild.id if getattr(text_channel, 'guild', None) is not None else None
+
+        # counters shared by every monitor, nothing is recorded without a registry
+        self.requests = None
+        self.frames_dropped = None
+        if metrics is not None:
+            self.requests = metrics.counter('monitor_requests_total', 'Messages sent, edited and deleted by game monitors', ('call',))
+            self.frames_dropped = metrics.counter('monitor_frames_dropped_total', 'Game frames replaced by a newer frame before they were sent')
+
         self.screen: DiscGameScreen = DiscGameScreen(GameDefaults.screen_size)
         self.action = ''
         self.content = ''
@@ -20,33 +67,190 @@ class DiscGameMonitor:
 
         self.lock = asyncio.Lock()
 
+        # render pipeline
+        self.max_fps = max_fps if max_fps is not None else GameDefaults.max_fps
+        self.frame = None               # newest pending frame, older frames are dropped
+        self.ordered = deque()          # (kwargs, future) delivered in order, future is None for frames
+        self.dropped_frames = 0
+        self.last_frame_time = 0
+
+        # frame dedup
+        self.delivered_digest = None    # digest of the content currently shown in self.message
+        self.edits_saved = 0
+        self.screen_version = -1        # screen version of self.screen_content
+        self.screen_content = None
+        self.ready = asyncio.Event()
+        self.flusher = None
+
+        # re-post policy
+        self.repost_policy = repost_policy if repost_policy is not None else GameDefaults.repost_policy
+        self.repost_interval = repost_interval if repost_interval is not None else GameDefaults.repost_interval
+        self.last_repost_time = 0
+
+        DiscGameMonitor.recent_messages.setdefault(text_channel.id, None)
+
+        self.bucket = DiscGameMonitor.buckets.get(text_channel.id)
+        if self.bucket is None:
+            self.bucket = EditBucket(GameDefaults.edit_bucket_size, GameDefaults.edit_bucket_period)
+            DiscGameMonitor.buckets[text_channel.id] = self.bucket
+
     async def send(self, content):
-        await self.__send(content=content)
+        self.__queue(content=content)
 
     async def send_game(self):
-        await self.__send(content=f'```{str(self.screen)}```')
+        text = self.screen.render()
+        if self.screen.version != self.screen_version:
+            self.screen_version = self.screen.version
+            self.screen_content = f'```{text}```'
+        self.__queue(content=self.screen_content)
 
     async def send_note(self, note):
-        await self.__send(content=note)
-    
+        self.__queue(content=note)
+
+    # Endcards are never dropped, wait until this one has been sent
     async def send_endcard(self, content):
-        await self.__send(content=content, nodelete=True)
+        future = asyncio.get_running_loop().create_future()
+
+        # a pending frame was sent before this endcard, keep it ahead
+        if self.frame is not None:
+            self.ordered.append((self.frame, None))
+            self.frame = None
+
+        self.ordered.append(({'content': content}, future))
+        self.__wake()
+        await future
+
+    # ===========================================
+    # Channel message tracking, fed by the bot's message listeners
+    @classmethod
+    def track_message(cls, channel_id, message_id):
+        recent = cls.recent_messages.get(channel_id)
+        if recent is not None and (not recent or recent[-1] != message_id):
+            recent.append(message_id)
+
+    @classmethod
+    def forget_message(cls, channel_id, message_id):
+        recent = cls.recent_messages.get(channel_id)
+        if recent is not None:
+            try:
+                recent.remove(message_id)
+            except ValueError:
+                return
+
+            # no longer know what is at the bottom of the channel
+            if not recent:
+                cls.recent_messages[channel_id] = None
+
+    # Tracked messages may be missing after a gateway reconnect
+    @classmethod
+    def invalidate_messages(cls):
+        for channel_id in cls.recent_messages:
+            cls.recent_messages[channel_id] = None
+
+    async def __last_message_id(self):
+        recent = DiscGameMonitor.recent_messages.get(self.tc.id)
+        if recent:
+            return recent[-1]
+
+        # fall back to the channel history
+        recent = deque(maxlen=16)
+        async for _msg in self.tc.history(limit=recent.maxlen):
+            recent.appendleft(_msg.id)
+        DiscGameMonitor.recent_messages[self.tc.id] = recent
+
+        return recent[-1] if recent else None
+
+    # ===========================================
+    # Render pipeline
+    def __queue(self, **kwargs):
+        if self.frame is not None:
+            self.dropped_frames += 1
+            if self.frames_dropped is not None:
+                self.frames_dropped.inc()
+
+        # no dedup here, an edit still in flight may change what the channel shows; __send checks once it's done
+        self.frame = kwargs
+        self.__wake()
+
+    @staticmethod
+    def __digest(kwargs):
+        payload = sorted((key, value.to_dict() if hasattr(value, 'to_dict') else value) for key, value in kwargs.items())
+        return hashlib.blake2b(repr(payload).encode(), digest_size=16).digest()
+
+    def __wake(self):
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.get_running_loop().create_task(self.__flush_loop())
+        self.ready.set()
+
+    async def __flush_loop(self):
+        while True:
+            if self.frame is None and not self.ordered:
+                self.ready.clear()
+                await self.ready.wait()
+
+            if self.frame is not None:
+
+                # hold the frame until the frame rate allows it, newer frames replace it meanwhile
+                delay = self.last_frame_time + 1 / self.max_fps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                # an endcard may have moved the frame into the ordered queue meanwhile, only pay for a frame we send
+                frame, self.frame = self.frame, None
+                if frame is not None:
+                    await self.bucket.acquire()
+
+                    # latest wins while waiting for the token too
+                    if self.frame is not None:
+                        frame, self.frame = self.frame, None
+                        self.dropped_frames += 1
+                        if self.frames_dropped is not None:
+                            self.frames_dropped.inc()
+
+                    try:
+                        await self.__send(**frame)
+                    except Exception:
+                        traceback.print_exc()
+                    self.last_frame_time = time.monotonic()
+
+            while self.ordered:
+                kwargs, future = self.ordered.popleft()
+                await self.bucket.acquire()
+                if future is None:
+                    try:
+                        await self.__send(**kwargs)
+                    except Exception:
+                        traceback.print_exc()
+                    self.last_frame_time = time.monotonic()
+                    continue
+                try:
+                    msg = await self.__call('endcard', 'send', self.tc.send, **kwargs)
+                    DiscGameMonitor.track_message(self.tc.id, msg.id)
+                    future.set_result(None)
+                except Exception as e:
+                    future.set_exception(e)
 
     async def __update_message(self):
-        async with self.lock: 
+        async with self.lock:
             msg = None
             if self.message is None:
-                msg = await self.tc.send('Generating...')
+                msg = await self.__post()
+            elif self.repost_policy == RepostPolicy.NEVER:
+                msg = self.message
+            elif time.monotonic() - self.last_repost_time < self.repost_interval:
+                msg = self.message
+            elif await self.__last_message_id() != self.message.id:
+
+                # never shed, a skipped delete would leave the old board next to the new one, and ahead of frames since the lock is held
+                try:
+                    await self.__call('endcard', 'delete', self.message.delete)
+                except NotFound:
+                    pass
+                DiscGameMonitor.forget_message(self.tc.id, self.message.id)
+                msg = await self.__post()
+                self.last_repost_time = time.monotonic()
             else:
-                async for _msg in self.tc.history(limit=1):
-                    if _msg.id != self.message.id:
-                        try:
-                            await self.message.delete()
-                        except NotFound:
-                            pass
-                        msg = await self.tc.send('Generating...')
-                    else:
-                        msg = _msg
+                msg = self.message
 
             if msg is not None:
                 self.message = msg
@@ -55,38 +259,215 @@ class DiscGameMonitor:
                 print('error updating the monitor message')
                 return False
 
-    async def __send(self, nodelete=False, **kwargs):
-        if nodelete:
-            await self.tc.send(**kwargs)
-        elif await self.__update_message():
+    async def __post(self, content='Generating...'):
+        self.delivered_digest = None
+        await self.bucket.acquire()
+        msg = await self.__call('frame', 'send', self.tc.send, content)
+        if msg is None:
+            return None
+        DiscGameMonitor.track_message(self.tc.id, msg.id)
+        return msg
+
+    async def __send(self, **kwargs):
+        digest = self.__digest(kwargs)
+        if await self.__update_message():
+            if digest == self.delivered_digest:
+                self.edits_saved += 1
+                return
+
+            # shed edits resolve to None, only remember frames that went out
+            message = self.message
+            async def edit():
+                await message.edit(**kwargs)
+                return True
+
             async with self.lock:
                 # chance that clean got here first
                 try:
-                    await self.message.edit(**kwargs)
+                    if await self.__call('frame', 'edit', edit):
+                        self.delivered_digest = digest
                 except NotFound:
                     pass
         else:
             print('error sending monitor')
 
+    # Discord call, through the outbound scheduler if there is one
+    async def __call(self, priority, route, func, *args, **kwargs):
+        if self.requests is not None:
+            self.requests.inc(route)
+        if self.outbound is None:
+            return await func(*args, **kwargs)
+        return await self.outbound.submit(priority, self.guild_id, (route, self.tc.id), func, *args, **kwargs)
+
     async def clean(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        self.frame = None
+        while self.ordered:
+            future = self.ordered.popleft()[1]
+            if future is not None:
+                future.cancel()
+
         async with self.lock:
             if self.message is not None:
                 try:
-                    await self.message.delete()
+                    await self.__call('endcard', 'delete', self.message.delete)
                 except NotFound:
                     pass
-        
+
+        DiscGameMonitor.recent_messages.pop(self.tc.id, None)
+
 class DiscGameScreen:
+    '''Character framebuffer stored as a grid of unicode codepoints
+
+    Every drawing call takes x (column) before y (row): screen[x, y], fill(char, x, y, ...),
+    blit(src, x, y), text(content, x, y). The old row-major matrix[y][x] still works.
+    '''
 
-    def __init__(self, size) -> None:
+    def __init__(self, size, background='.') -> None:
         self.size = size
+        self.background = background
+        self.version = 0            # bumped whenever the rendered text changes
 
         self.__set_matrix()
 
     def __str__(self) -> str:
-        return '\n'.join([''.join(self.matrix[i]) for i in range(self.size)])
+        return self.render()
+
+    # Rows of the screen as matrix[y][x], writes go through to the framebuffer
+    @property
+    def matrix(self):
+        return [ScreenRow(self, y) for y in range(self.height)]
+
+    # Re-encode only the rows that were drawn on since the last render
+    def render(self) -> str:
+        if self.dirty:
+            changed = False
+            for i in self.dirty:
+                line = self.buffer[i].tobytes().decode(ENCODING)
+                if line != self.__lines[i]:
+                    self.__lines[i] = line
+                    changed = True
+            self.dirty.clear()
+
+            if changed:
+                self.__text = '\n'.join(self.__lines)
+                self.version += 1
+
+        return self.__text
+
+    # ===========================================
+    # Drawing
+    def __getitem__(self, pos) -> str:
+        x, y = pos
+        return chr(self.buffer[y, x])
+
+    def __setitem__(self, pos, char):
+        x, y = pos
+        self.buffer[y, x] = ord(char)
+        self.dirty.add(y)
+
+    # Fill a rectangle (the whole screen by default)
+    def fill(self, char=None, x=0, y=0, width=None, height=None):
+        if char is None:
+            char = self.background
+        region = self.__clip(x, y, self.width if width is None else width, self.height if height is None else height)
+        if region is None:
+            return
+        rows, cols, _, _ = region
+        self.buffer[rows, cols] = ord(char)
+        self.dirty.update(range(rows.start, rows.stop))
+
+    def clear(self):
+        self.fill(self.background)
+
+    # Copy a block of codepoints (2D array or list of strings) onto the screen
+    def blit(self, src, x, y):
+        src = to_codepoints(src)
+        region = self.__clip(x, y, src.shape[1], src.shape[0])
+        if region is None:
+            return
+        rows, cols, src_rows, src_cols = region
+        self.buffer[rows, cols] = src[src_rows, src_cols]
+        self.dirty.update(range(rows.start, rows.stop))
+
+    # Like blit, but the transparent character leaves the screen underneath untouched
+    def sprite(self, src, x, y, transparent=' '):
+        src = to_codepoints(src)
+        region = self.__clip(x, y, src.shape[1], src.shape[0])
+        if region is None:
+            return
+        rows, cols, src_rows, src_cols = region
+        block = src[src_rows, src_cols]
+        mask = block != ord(transparent)
+        self.buffer[rows, cols][mask] = block[mask]
+        self.dirty.update(range(rows.start, rows.stop))
+
+    # Straight line between two points, inclusive
+    def line(self, x0, y0, x1, y1, char):
+        n = max(abs(x1 - x0), abs(y1 - y0)) + 1
+        xs = np.rint(np.linspace(x0, x1, n)).astype(np.intp)
+        ys = np.rint(np.linspace(y0, y1, n)).astype(np.intp)
+
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys = xs[inside], ys[inside]
+        self.buffer[ys, xs] = ord(char)
+        self.dirty.update(ys.tolist())
+
+    # Single line of text starting at (x, y)
+    def text(self, content, x, y):
+        self.blit([content], x, y)
+
+    # ===========================================
+    # Internals
+    # Clip a rectangle to the screen, returns (rows, cols, src_rows, src_cols) slices
+    def __clip(self, x, y, width, height):
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return slice(y0, y1), slice(x0, x1), slice(y0 - y, y1 - y), slice(x0 - x, x1 - x)
 
     def __set_matrix(self, size=-1):
         if size == -1:
             size = self.size
-        self.matrix = [['.' for _ in range(self.size)] for _ in range(self.size)]
+        if isinstance(size, int):
+            size = (size, size)
+
+        self.width, self.height = size
+        self.buffer = np.full((self.height, self.width), ord(self.background), dtype=CODEPOINT)
+        self.dirty = set(range(self.height))
+        self.__lines = [None] * self.height
+        self.__text = ''
+
+
+class ScreenRow:
+    '''One screen row for the matrix[y][x] interface'''
+
+    __slots__ = ('screen', 'y')
+
+    def __init__(self, screen, y) -> None:
+        self.screen = screen
+        self.y = y
+
+    def __getitem__(self, x) -> str:
+        return self.screen[x, self.y]
+
+    def __setitem__(self, x, char):
+        self.screen[x, self.y] = char
+
+    def __len__(self) -> int:
+        return self.screen.width
+
+    def __iter__(self):
+        return (chr(c) for c in self.screen.buffer[self.y])
+
+
+# Convert a list of equal length strings (or an existing array) to a 2D codepoint array
+def to_codepoints(src):
+    if isinstance(src, np.ndarray):
+        return src
+    width = max((len(row) for row in src), default=0)
+    data = ''.join(row.ljust(width) for row in src).encode(ENCODING)
+    return np.frombuffer(data, dtype=CODEPOINT).reshape(len(src), width)
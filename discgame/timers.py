@@ -0,0 +1,88 @@
+# Deadline timers for games, one heap and one loop callback for all of them
+
+import asyncio, heapq, itertools, traceback
+
+
+class Deadline:
+    '''Handle for a callback registered with TimerHeap'''
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args) -> None:
+        self.when = when            # loop time the callback runs at
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerHeap:
+    '''Min-heap of deadlines, only the earliest one is armed with loop.call_at'''
+
+    shared_heap = None
+
+    def __init__(self) -> None:
+        self.heap = []              # (when, seq, Deadline)
+        self.seq = itertools.count()
+        self.armed = None           # asyncio.TimerHandle for the head of the heap
+        self.armed_at = None
+        self.loop = None
+
+    # Process-wide heap shared by every game
+    @classmethod
+    def shared(cls):
+        if cls.shared_heap is None:
+            cls.shared_heap = cls()
+        return cls.shared_heap
+
+    # Run callback(*args) delay seconds from now
+    def call_later(self, delay, callback, *args) -> Deadline:
+        loop = asyncio.get_running_loop()
+        return self.call_at(loop.time() + delay, callback, *args)
+
+    # Run callback(*args) at loop time when
+    def call_at(self, when, callback, *args) -> Deadline:
+        self.loop = asyncio.get_running_loop()
+        deadline = Deadline(when, callback, args)
+        heapq.heappush(self.heap, (when, next(self.seq), deadline))
+        if self.armed_at is None or when < self.armed_at:
+            self.__arm()
+        return deadline
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    # ===========================================
+    # Internals
+    def __arm(self):
+        if self.armed is not None:
+            self.armed.cancel()
+            self.armed = None
+            self.armed_at = None
+
+        # cancelled deadlines are dropped lazily when they reach the head
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+
+        if self.heap:
+            self.armed_at = self.heap[0][0]
+            self.armed = self.loop.call_at(self.armed_at, self.__fire)
+
+    def __fire(self):
+        self.armed = None
+        self.armed_at = None
+
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            deadline = heapq.heappop(self.heap)[2]
+            if deadline.cancelled:
+                continue
+            deadline.cancelled = True
+            try:
+                deadline.callback(*deadline.args)
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+
+        self.__arm()
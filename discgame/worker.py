@@ -0,0 +1,150 @@
+# Run a DiscGame in a worker process, away from the bot's event loop
+
+import asyncio, sys, importlib
+
+from concurrent.futures.process import BrokenProcessPool
+
+from .constants import GameDefaults
+from .game import DiscGame
+from .monitor import DiscGameScreen
+
+# ========================================
+# Worker side
+# Games hosted by this process and the loop their coroutines run on
+hosted = {} # game_id: (DiscGame, WorkerMonitor)
+loop = None
+
+
+class WorkerMonitor:
+    '''Stands in for DiscGameMonitor inside a worker, recording render commands for the host'''
+
+    def __init__(self) -> None:
+        self.screen: DiscGameScreen = DiscGameScreen(GameDefaults.screen_size)
+        self.action = ''
+        self.content = ''
+        self.footer = ''
+
+        self.screen_version = -1
+        self.commands = [] # (command, content) since the last call
+
+    async def send(self, content):
+        self.commands.append(('send', content))
+
+    # The screen text only crosses the process boundary when it changed
+    async def send_game(self):
+        text = self.screen.render()
+        if self.screen.version != self.screen_version:
+            self.screen_version = self.screen.version
+            self.commands.append(('send_game', text))
+        else:
+            self.commands.append(('send_game', None))
+
+    async def send_note(self, note):
+        self.commands.append(('send_note', note))
+
+    async def send_endcard(self, content):
+        self.commands.append(('send_endcard', content))
+
+
+def create_game(game_id, lib_path, module_name, class_name):
+    global loop
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    if lib_path not in sys.path:
+        sys.path.append(lib_path)
+
+    cls = getattr(importlib.import_module(module_name), class_name)
+    monitor = WorkerMonitor()
+    hosted[game_id] = (cls(monitor), monitor)
+    return cls.tick_policy, cls.tick_queue_size, cls.input_batch
+
+# Run one of the game's coroutines to completion, returns the render commands it made
+def call_game(game_id, name, args):
+    game, monitor = hosted[game_id]
+    monitor.commands = []
+    loop.run_until_complete(getattr(game, name)(*args))
+    return monitor.commands
+
+def destroy_game(game_id):
+    hosted.pop(game_id, None)
+
+
+# ========================================
+# Host side
+class ProcessGame(DiscGame):
+    '''Host side of a game running in a worker process.
+    Ticks and messages are forwarded to the worker, its render commands are replayed on the real monitor'''
+
+    def __init__(self, monitor, pool, module_name, class_name, lib_path) -> None:
+        super().__init__(monitor)
+
+        self.pool = pool
+        self.worker = None
+        self.game_id = id(self)
+        self.spec = (lib_path, module_name, class_name)
+        self.screen_content = None
+
+    async def start(self):
+        self.worker = self.pool.acquire()
+        tick_policy, tick_queue_size, self.input_batch = await self.__run(create_game, self.game_id, *self.spec)
+
+        # the game class' tick settings apply unless games.json overrides them
+        if 'tick_policy' not in self.__dict__:
+            self.tick_policy = tick_policy
+        if 'tick_queue_size' not in self.__dict__:
+            self.tick_queue_size = tick_queue_size
+
+        await self.__call('_start_interal')
+
+    async def end(self):
+        if self.worker is None:
+            return
+        try:
+            await self.__call('_end_internal')
+            await self.__run(destroy_game, self.game_id)
+        finally:
+            if self.worker is not None:
+                self.pool.release(self.worker)
+                self.worker = None
+
+    async def join(self):
+        await self.__call('_join_internal')
+
+    async def leave(self):
+        await self.__call('leave')
+
+    async def message(self, user_id, content):
+        await self.__call('_message_interal', user_id, content)
+
+    # A whole batch crosses to the worker in one call
+    async def messages(self, batch):
+        await self.__call('_messages_internal', batch)
+
+    async def every_second(self):
+        await self.__call('_every_second_interal')
+
+    async def every_minute(self):
+        await self.__call('_every_minute_interal')
+
+    # ========================================
+    # Internals
+    async def __call(self, name, *args):
+        for command, content in await self.__run(call_game, self.game_id, name, args):
+            if command == 'send_game':
+                if content is not None:
+                    self.screen_content = f'```{content}```'
+                await self.monitor.send(self.screen_content)
+            else:
+                await getattr(self.monitor, command)(content)
+
+    async def __run(self, func, *args):
+        if self.worker is None:
+            raise BrokenProcessPool(f'Game worker for {self.spec[1]} is gone')
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.worker, func, *args)
+        except BrokenProcessPool:
+            self.pool.discard(self.worker)
+            self.worker = None
+            raise
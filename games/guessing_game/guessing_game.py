@@ -23,7 +23,7 @@ class GuessingGame(DiscGame):
     async def leave(self):
         pass
 
-    async def message(self):
+    async def message(self, user_id, content):
         pass
 
     async def every_second(self):
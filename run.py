@@ -33,8 +33,18 @@ def main() -> int:
 
     check_env()
 
+    # games against a fake Discord, prints a load report
+    if '--simulate' in sys.argv:
+        from bot.simulate import main as simulate
+        return simulate(sys.argv[1:])
+
     from bot.runner import Runner
     runner = Runner()
+
+    # shards split over supervised worker processes
+    if '--sharded' in sys.argv:
+        return runner.run_sharded()
+
     return runner.run()
 
 if __name__ == '__main__':
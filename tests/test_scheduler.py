@@ -0,0 +1,45 @@
+
+import asyncio
+
+from bot.tools.scheduler import Scheduler
+from bot.tools.util import Singleton
+
+
+# A scheduler of its own with short ticks, outside the process-wide instance
+def new_scheduler(resolution=0.01):
+    return super(Singleton, Scheduler).__call__(resolution)
+
+
+def test_register_after_all_timers_cancelled():
+    async def run():
+        scheduler = new_scheduler()
+        first, second = [], []
+
+        timer = scheduler.every(0.01, lambda: first.append(1))
+        await asyncio.sleep(0.1)
+        scheduler.cancel(timer)
+        assert first
+
+        # the run loop is idle with nothing registered, a new timer has to wake it
+        await asyncio.sleep(0.05)
+        scheduler.every(0.01, lambda: second.append(1))
+        await asyncio.sleep(0.1)
+        scheduler.stop()
+        return second
+
+    assert asyncio.run(run())
+
+
+def test_cancelled_timers_do_not_wake_the_loop():
+    async def run():
+        scheduler = new_scheduler()
+        scheduler.every(1, lambda: None)
+        timer = scheduler.call_later(0.3, lambda: None)
+        scheduler.cancel(timer)
+        await asyncio.sleep(0.01)
+        pending = scheduler.sleep_until
+        scheduler.stop()
+        return pending
+
+    # the next wakeup is the wheel cascade at tick 60, not the cancelled timer at tick 30
+    assert asyncio.run(run()) == 60